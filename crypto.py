@@ -0,0 +1,337 @@
+import binascii, hashlib, hmac
+import os
+import rsa, rsa.pkcs1, pyaes
+from base64 import b64encode, b64decode
+
+
+class CryptoError(Exception):
+    """Класс исключений для индикации ошибки расшифровки
+    или проверки подписи"""
+
+
+class PureBackend:
+    """Реализация шифрования на pyaes и rsa, написанных на Python"""
+    name = 'pure'
+
+    def aes_ctr(self, key, counter, data):
+        """Шифрует (и расшифровывает) байт-строку data AES-CTR
+        с ключом key и начальным значением 128-битного счетчика counter
+        Вызывает ValueError, если у ключа неверная длина"""
+        aes = pyaes.AESModeOfOperationCTR(key, pyaes.Counter(counter))
+        return aes.encrypt(data)
+
+    def rsa_decrypt(self, data, priv_key):
+        """Расшифровывает data приватным ключом priv_key (PKCS#1 v1.5)
+        Вызывает CryptoError, если расшифровать не удалось"""
+        try:
+            return rsa.decrypt(data, priv_key)
+        except rsa.pkcs1.DecryptionError:
+            raise CryptoError
+
+    def rsa_encrypt(self, data, pub_key):
+        """Зашифровывает data публичным ключом pub_key (PKCS#1 v1.5)"""
+        return rsa.encrypt(data, pub_key)
+
+    def rsa_verify(self, data, signature, pub_key):
+        """Проверяет подпись signature байт-строки data
+        публичным ключом pub_key
+        Вызывает CryptoError, если проверка не пройдена"""
+        try:
+            rsa.verify(data, signature, pub_key)
+        except rsa.pkcs1.VerificationError:
+            raise CryptoError
+
+
+class NativeBackend(PureBackend):
+    """Реализация шифрования на библиотеке cryptography (OpenSSL)
+    Результат совпадает с PureBackend байт в байт; проверка подписи
+    остается за rsa, потому что операция с открытым ключом дешевая
+    Вызывает ImportError, если cryptography не установлена"""
+    name = 'native'
+
+    def __init__(self):
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.asymmetric import padding
+        from cryptography.hazmat.primitives.asymmetric import rsa as c_rsa
+        from cryptography.hazmat.primitives.ciphers import (Cipher,
+                                                            algorithms,
+                                                            modes)
+        self._backend = default_backend()
+        self._padding = padding.PKCS1v15()
+        self._rsa = c_rsa
+        self._cipher = Cipher
+        self._algorithm = algorithms.AES
+        self._mode = modes.CTR
+        # Приватные ключи rsa, преобразованные в ключи cryptography
+        # Публичные ключи клиентов не сохраняются: их столько же,
+        # сколько клиентов, а преобразование дешевое
+        self._keys = {}
+
+    def _private_key(self, priv_key):
+        key = self._keys.get((priv_key.n, priv_key.d))
+        if key is None:
+            c_rsa = self._rsa
+            numbers = c_rsa.RSAPrivateNumbers(
+                priv_key.p, priv_key.q, priv_key.d,
+                priv_key.exp1, priv_key.exp2, priv_key.coef,
+                c_rsa.RSAPublicNumbers(priv_key.e, priv_key.n))
+            key = numbers.private_key(self._backend)
+            self._keys[priv_key.n, priv_key.d] = key
+        return key
+
+    def _public_key(self, pub_key):
+        numbers = self._rsa.RSAPublicNumbers(pub_key.e, pub_key.n)
+        return numbers.public_key(self._backend)
+
+    def aes_ctr(self, key, counter, data):
+        if len(key) not in (16, 24, 32):
+            raise ValueError('Invalid key size')
+        # Счетчик pyaes переполняется по модулю 2 ** 128, как и в OpenSSL
+        block = (counter % (1 << 128)).to_bytes(16, 'big')
+        cipher = self._cipher(self._algorithm(key), self._mode(block),
+                              self._backend)
+        enc = cipher.encryptor()
+        return enc.update(data) + enc.finalize()
+
+    def rsa_decrypt(self, data, priv_key):
+        try:
+            return self._private_key(priv_key).decrypt(data, self._padding)
+        except ValueError:
+            raise CryptoError
+
+    def rsa_encrypt(self, data, pub_key):
+        return self._public_key(pub_key).encrypt(data, self._padding)
+
+
+class NumpyBackend(PureBackend):
+    """Реализация AES-CTR на NumPy: поток ключей вычисляется табличными
+    поисками сразу для всех блоков, а затем одной операцией складывается
+    с данными по модулю 2. Используются таблицы и расписание ключей pyaes,
+    поэтому результат совпадает с PureBackend байт в байт
+    Вызывает ImportError, если NumPy не установлен"""
+    name = 'numpy'
+
+    # Число блоков, которые шифруются за один проход,
+    # чтобы ограничить размер промежуточных массивов
+    chunk_blocks = 1 << 16
+
+    def __init__(self):
+        import numpy
+        self._np = numpy
+        tables = (pyaes.AES.T1, pyaes.AES.T2, pyaes.AES.T3, pyaes.AES.T4,
+                  pyaes.AES.S)
+        self._t1, self._t2, self._t3, self._t4, self._s = (
+            numpy.array(t, dtype = numpy.uint32) for t in tables)
+
+    def _counter_blocks(self, counter, start, count):
+        """Возвращает массив (count, 4) 32-битных слов счетчика
+        для блоков с номерами от start до start + count"""
+        np = self._np
+        counter = (counter + start) % (1 << 128)
+        high = np.uint64(counter >> 64)
+        low = np.uint64(counter & 0xFFFFFFFFFFFFFFFF)
+
+        lows = low + np.arange(count, dtype = np.uint64)
+        # Перенос в старшие 64 бита при переполнении младших
+        highs = high + (lows < low).astype(np.uint64)
+
+        blocks = np.empty((count, 4), dtype = np.uint32)
+        blocks[:, 0] = highs >> np.uint64(32)
+        blocks[:, 1] = highs & np.uint64(0xFFFFFFFF)
+        blocks[:, 2] = lows >> np.uint64(32)
+        blocks[:, 3] = lows & np.uint64(0xFFFFFFFF)
+        return blocks
+
+    def _encrypt_blocks(self, ke, t):
+        """Шифрует массив блоков t из 32-битных слов AES
+        с расписанием ключей ke, как AES.encrypt в pyaes"""
+        np = self._np
+        t1, t2, t3, t4, s = self._t1, self._t2, self._t3, self._t4, self._s
+        rounds = len(ke) - 1
+
+        t = t ^ ke[0]
+        for r in range(1, rounds):
+            a = np.empty_like(t)
+            for i in range(4):
+                a[:, i] = (t1[t[:, i] >> 24] ^
+                           t2[(t[:, (i + 1) % 4] >> 16) & 0xFF] ^
+                           t3[(t[:, (i + 2) % 4] >> 8) & 0xFF] ^
+                           t4[t[:, (i + 3) % 4] & 0xFF] ^
+                           ke[r][i])
+            t = a
+
+        # Последний раунд использует S-блок вместо таблиц
+        result = np.empty_like(t)
+        for i in range(4):
+            result[:, i] = ((s[t[:, i] >> 24] << 24) |
+                            (s[(t[:, (i + 1) % 4] >> 16) & 0xFF] << 16) |
+                            (s[(t[:, (i + 2) % 4] >> 8) & 0xFF] << 8) |
+                            s[t[:, (i + 3) % 4] & 0xFF]) ^ ke[rounds][i]
+        return result
+
+    def aes_ctr(self, key, counter, data):
+        np = self._np
+        # Часть слов расписания pyaes хранит как отрицательные числа,
+        # значимы только их младшие 32 бита
+        ke = np.array(pyaes.AES(key)._Ke, dtype = np.int64).astype(np.uint32)
+        data = np.frombuffer(data, dtype = np.uint8)
+        out = np.empty_like(data)
+
+        blocks = (len(data) + 15) // 16
+        for start in range(0, blocks, self.chunk_blocks):
+            count = min(self.chunk_blocks, blocks - start)
+            stream = self._encrypt_blocks(
+                ke, self._counter_blocks(counter, start, count))
+            # Слова pyaes записываются в порядке big-endian
+            stream = np.frombuffer(stream.astype('>u4').tobytes(),
+                                   dtype = np.uint8)
+
+            begin = start * 16
+            end = min(begin + count * 16, len(data))
+            out[begin:end] = data[begin:end] ^ stream[:end - begin]
+        return out.tobytes()
+
+
+# Реализации в порядке предпочтения
+BACKENDS = (NativeBackend, NumpyBackend, PureBackend)
+
+
+def get_backend(name = None):
+    """Возвращает реализацию шифрования с именем name
+    ('native', 'numpy' или 'pure')
+    По умолчанию берется CRYPTO_BACKEND, а если он не задан -
+    первая из BACKENDS, для которой установлены библиотеки
+    Вызывает ValueError, если реализации с именем name нет"""
+    name = name or os.getenv('CRYPTO_BACKEND')
+    for cls in BACKENDS:
+        if name and cls.name != name:
+            continue
+        try:
+            return cls()
+        except ImportError:
+            if name:
+                raise
+    raise ValueError('unknown crypto backend: {}'.format(name))
+
+
+# Функции этого модуля не обращаются к базе данных, а реализация
+# хранит только преобразованный приватный ключ сервера, поэтому их
+# можно выполнять в отдельных процессах
+backend = get_backend()
+
+# Длина сессионного ключа AES, который выдается при входе
+KEY_SIZE = 32
+
+# Длина nonce, который передается с каждым запросом и ответом,
+# зашифрованным сессионным ключом
+NONCE_SIZE = 8
+
+# Длина кода аутентификации HMAC-SHA256, который клиент может передавать
+# вместо подписи RSA
+MAC_SIZE = hashlib.sha256().digest_size
+
+# Начальное значение счетчика AES-CTR для ключа, переданного через RSA
+# (значение по умолчанию в pyaes)
+RSA_COUNTER = 1
+
+
+def new_session_key():
+    """Создает сессионный ключ AES"""
+    return os.urandom(KEY_SIZE)
+
+
+def is_mac(signature):
+    """Проверяет, является ли подпись signature кодом аутентификации
+    HMAC, а не подписью RSA"""
+    return len(signature) == MAC_SIZE
+
+
+def mac(request, enc_key, key):
+    """Вычисляет HMAC-SHA256 сессионным ключом key от запроса
+    в том виде, в котором он передается: request:enc_key"""
+    return hmac.new(key, request + b':' + enc_key, hashlib.sha256).digest()
+
+
+def verify_mac(request, enc_key, signature, key):
+    """Проверяет код аутентификации signature запроса request
+    с ключом enc_key сессионным ключом key
+    Вызывает CryptoError, если проверка не пройдена"""
+    if not hmac.compare_digest(mac(request, enc_key, key), signature):
+        raise CryptoError
+
+
+def is_nonce(enc_key):
+    """Проверяет, передан ли в поле ключа запроса nonce вместо
+    ключа AES, зашифрованного RSA"""
+    try:
+        return len(b64decode(enc_key)) == NONCE_SIZE
+    except binascii.Error:
+        return False
+
+
+def _session_counter(nonce):
+    """Возвращает начальное значение счетчика AES-CTR для сессионного
+    ключа: старшие 64 бита занимает nonce, а младшие - номер блока,
+    поэтому при разных nonce потоки ключей не пересекаются"""
+    return int.from_bytes(nonce, 'big') << 64
+
+
+def decrypt(request, enc_key, priv_key):
+    """Расшифровывает байт-строку request в base64 через ключ enc_key,
+    зашифрованный публичным ключом сервера
+    Вызывает CryptoError, если расшифровать строку не удалось"""
+    try:
+        decoded_request = b64decode(request)
+        decoded_key = b64decode(enc_key)
+    except binascii.Error:
+        raise CryptoError
+    key = backend.rsa_decrypt(decoded_key, priv_key)
+
+    try:
+        return backend.aes_ctr(key, RSA_COUNTER, decoded_request)
+    except ValueError:
+        # Если у расшифрованного ключа неверная длина
+        raise CryptoError
+
+
+def encrypt(response, pub_key):
+    """Зашифровывает байт-строку response AES-шифрованием, а ключ
+    шифрует публичным ключом клиента pub_key"""
+    key = os.urandom(32)
+    enc_response = backend.aes_ctr(key, RSA_COUNTER, response)
+    enc_key = backend.rsa_encrypt(key, pub_key)
+
+    return b64encode(enc_response) + b':' + b64encode(enc_key)
+
+
+def verify(request, signature, pub_key):
+    """Проверяет подлинность подписи signature байт-строки request в base64
+    публичным ключом pub_key
+    Вызывает CryptoError, если проверка не пройдена"""
+    decoded_request = b64decode(request)
+    backend.rsa_verify(decoded_request, signature, pub_key)
+
+
+def session_decrypt(request, nonce, key):
+    """Расшифровывает байт-строку request в base64 сессионным ключом key
+    с nonce в base64
+    Вызывает CryptoError, если расшифровать строку не удалось"""
+    try:
+        decoded_request = b64decode(request)
+        decoded_nonce = b64decode(nonce)
+    except binascii.Error:
+        raise CryptoError
+    if len(decoded_nonce) != NONCE_SIZE:
+        raise CryptoError
+
+    return backend.aes_ctr(key, _session_counter(decoded_nonce),
+                           decoded_request)
+
+
+def session_encrypt(response, key):
+    """Зашифровывает байт-строку response сессионным ключом key
+    со случайным nonce, который передается вместо ключа"""
+    nonce = os.urandom(NONCE_SIZE)
+    enc_response = backend.aes_ctr(key, _session_counter(nonce), response)
+
+    return b64encode(enc_response) + b':' + b64encode(nonce)
@@ -0,0 +1,79 @@
+import argparse, os, time, rsa
+import crypto
+
+
+def measure(func, min_time):
+    """Вызывает func, пока не пройдет min_time секунд
+    Возвращает число вызовов в секунду"""
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return count / elapsed
+
+
+def check_compatibility(backends, pub_key, priv_key):
+    """Проверяет, что все реализации дают одинаковый результат"""
+    key = os.urandom(crypto.KEY_SIZE)
+    data = os.urandom(100003)
+    counter = int.from_bytes(os.urandom(crypto.NONCE_SIZE), 'big') << 64
+    results = {b.name: b.aes_ctr(key, counter, data) for b in backends}
+    if len(set(results.values())) != 1:
+        raise AssertionError('AES-CTR output differs between backends')
+
+    enc_key = rsa.encrypt(key, pub_key)
+    sign = rsa.sign(data, priv_key, 'SHA-256')
+    for b in backends:
+        if b.rsa_decrypt(enc_key, priv_key) != key:
+            raise AssertionError(b.name + ' failed to decrypt RSA')
+        if rsa.decrypt(b.rsa_encrypt(key, pub_key), priv_key) != key:
+            raise AssertionError(b.name + ' failed to encrypt RSA')
+        b.rsa_verify(data, sign, pub_key)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark AES-CTR and RSA on each crypto backend')
+    parser.add_argument('--size', type = int, default = 1 << 20,
+                        help = 'AES payload size in bytes')
+    parser.add_argument('--bits', type = int, default = 2048,
+                        help = 'RSA key size')
+    parser.add_argument('--time', type = float, default = 1.0,
+                        help = 'seconds spent on each measurement')
+    args = parser.parse_args()
+
+    backends = []
+    for cls in crypto.BACKENDS:
+        try:
+            backends.append(cls())
+        except ImportError:
+            print(cls.name + ' backend is not installed, skipped')
+
+    pub_key, priv_key = rsa.newkeys(args.bits, accurate = False)
+    check_compatibility(backends, pub_key, priv_key)
+    print('output is identical on: ' + ', '.join(b.name for b in backends))
+    print()
+
+    key = os.urandom(crypto.KEY_SIZE)
+    data = os.urandom(args.size)
+    enc_key = rsa.encrypt(key, pub_key)
+    sign = rsa.sign(key, priv_key, 'SHA-256')
+
+    row = '{:<8}{:>14}{:>16}{:>16}{:>16}'
+    print(row.format('backend', 'AES MB/s', 'decrypt ops/s',
+                     'encrypt ops/s', 'verify ops/s'))
+    for b in backends:
+        aes = measure(lambda: b.aes_ctr(key, crypto.RSA_COUNTER, data),
+                      args.time) * args.size / 1e6
+        dec = measure(lambda: b.rsa_decrypt(enc_key, priv_key), args.time)
+        enc = measure(lambda: b.rsa_encrypt(key, pub_key), args.time)
+        ver = measure(lambda: b.rsa_verify(key, sign, pub_key), args.time)
+        print(row.format(b.name, '{:.2f}'.format(aes), '{:.1f}'.format(dec),
+                         '{:.1f}'.format(enc), '{:.1f}'.format(ver)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Операции RSA и AES нагружают процессор и удерживают GIL, поэтому
+# выполняются в отдельных процессах (CRYPTO_WORKERS = 0 - по числу ядер)
+# Процессы создаются fork'ом и наследуют открытые дескрипторы, поэтому
+# модуль импортируется раньше, чем открываются соединения с базой данных
+# и сокеты сервера, и все процессы пула запускаются сразу при импорте
+executor = ProcessPoolExecutor(int(os.getenv('CRYPTO_WORKERS', 0)) or None)
+executor.submit(int).result()
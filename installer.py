@@ -3,6 +3,9 @@ from urllib.parse import urlparse
 
 
 class Installer:
+    # Число секций таблицы сообщений
+    message_partitions = 16
+
     def connect(self):
         self.url = urlparse(os.environ["DATABASE_URL"])
 
@@ -16,12 +19,9 @@ class Installer:
         c = self.db.cursor()
 
         c.execute('''CREATE TABLE users (name text PRIMARY KEY,
-                                         password text,
+                                         password text)''')
 
-                                         friends text ARRAY,
-                                         favorites text ARRAY,
-                                         blacklist text ARRAY,
-                                         dialogs text ARRAY)''')
+        self.create_relations(c)
 
         c.execute('''CREATE TABLE profiles (name text PRIMARY KEY
                                             REFERENCES users(name),
@@ -32,21 +32,84 @@ class Installer:
                                             about text,
                                             image bytea)''')
 
-        c.execute('''CREATE TABLE sessions (name text,
-                                            pub_key text ARRAY,
-                                            ip text UNIQUE,
-                                            last_active bigint)''')
+        # Сессии не нужны после перезапуска сервера, поэтому таблица
+        # нежурналируемая: ее изменения не пишутся в WAL
+        c.execute('''CREATE UNLOGGED TABLE sessions (name text,
+                                                     pub_key text ARRAY,
+                                                     ip text UNIQUE,
+                                                     last_active bigint,
+                                                     sym_key bytea,
+                                                     mac_key bytea)''')
+        self.create_session_indexes(c)
 
         c.execute('''CREATE TABLE requests (from_who text,
                                             to_who text,
                                             message text)''')
+        self.create_request_indexes(c)
 
         c.execute('''CREATE TABLE key (pub_key text ARRAY,
                                        priv_key text ARRAY)''')
 
+        self.create_messages(c)
+
         self.db.commit()
         c.close()
 
+    def create_request_indexes(self, c):
+        """Создает индексы для поиска запросов на добавление
+        по отправителю и по получателю"""
+        c.execute('''CREATE INDEX IF NOT EXISTS requests_from_who
+                     ON requests (from_who)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS requests_to_who
+                     ON requests (to_who)''')
+
+    def create_session_indexes(self, c):
+        """Создает индекс для поиска сессий, неактивных
+        дольше заданного времени"""
+        c.execute('''CREATE INDEX IF NOT EXISTS sessions_last_active
+                     ON sessions (last_active)''')
+
+    def create_relations(self, c):
+        """Создает таблицу связей пользователей: друзей, избранных,
+        заблокированных и диалогов. Каждая связь хранится отдельной строкой
+        (владелец, вид связи, цель)"""
+        c.execute('''CREATE TABLE relations (id bigserial,
+                                             owner text REFERENCES users(name)
+                                                   ON DELETE CASCADE,
+                                             kind text,
+                                             target text,
+
+                                             PRIMARY KEY (owner, kind,
+                                                          target))''')
+
+        # Обратный индекс: кто добавил target в свой список
+        c.execute('''CREATE INDEX relations_target
+                     ON relations (target, kind)''')
+
+    def create_messages(self, c):
+        """Создает таблицу диалогов и общую для всех диалогов таблицу
+        сообщений, разбитую на секции по номеру диалога"""
+        c.execute('''CREATE TABLE dialogs (id serial PRIMARY KEY)''')
+
+        c.execute('''CREATE TABLE messages (id bigserial,
+                                            dialog integer,
+                                            content text,
+                                            timestamp bigint,
+                                            sender text,
+
+                                            PRIMARY KEY (dialog,
+                                                         timestamp, id))
+                     PARTITION BY HASH (dialog)''')
+
+        # Индекс для постраничного чтения истории по номерам сообщений
+        c.execute('''CREATE INDEX messages_dialog_id
+                     ON messages (dialog, id)''')
+
+        for i in range(self.message_partitions):
+            c.execute('''CREATE TABLE messages_{0} PARTITION OF messages
+                         FOR VALUES WITH (MODULUS {1}, REMAINDER {0})'''
+                      .format(i, self.message_partitions))
+
     def seed_database(self):
         pubkey, privkey = rsa.newkeys(2048, accurate = False)
 
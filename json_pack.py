@@ -41,6 +41,7 @@ class ClientCodes(IntEnum):
     get_add_requests = 26
     decline_add_request = 27
     set_image = 28
+    sync = 29
 
 class ServerCodes(IntEnum):
     login_error = 0
@@ -74,6 +75,7 @@ class ServerCodes(IntEnum):
     add_requests = 28
     decline_add_request_succ = 29
     set_image_succ = 30
+    sync_result = 31
 
 def main():
     cc = ClientCodes
@@ -152,7 +154,10 @@ def main():
     sc.decline_add_request_succ,
 
     cc.set_image:
-    sc.set_image_succ
+    sc.set_image_succ,
+
+    cc.sync:
+    sc.sync_result
     }
 
     s_to_c = {
@@ -191,6 +196,12 @@ def main():
     data = (cc.get_message_history, 'request_id', 'session_id', 0, 'dialog', 'ip')
     packed_info(data, 'Retrieve last n messages (0 to get all)')
 
+    data = (cc.get_message_history, 'request_id', 'session_id', 0, 'dialog', 'before_id', 'ip')
+    packed_info(data, 'Retrieve n messages sent before the message before_id')
+
+    data = (cc.get_message_history, 'request_id', 'session_id', 0, 'dialog', None, 'after_id', 'ip')
+    packed_info(data, 'Retrieve n messages sent after the message after_id')
+
     int_timestamp = int(time())
     # msg_id is assigned by a server
     data = (cc.send_message, 'request_id', 'session_id', 'crypt_mycrypt_msg', int_timestamp, 'crypt_dialog', 'ip')
@@ -266,6 +277,12 @@ def main():
     data = (cc.set_image, 'request_id', 'session_id', 'crypt_binary_img', 'ip')
     packed_info(data, 'Set the profile image')
 
+    data = (cc.sync, 'request_id', 'session_id', 'last_msg_id', 'ip')
+    packed_info(data, 'Get new messages from all dialogs')
+
+    data = (cc.sync, 'request_id', 'session_id', {'dialog': 'last_msg_id'}, 'ip')
+    packed_info(data, 'Get new messages from all dialogs, per dialog watermarks')
+
     print('Server -> Client\n\n')
 
     data = (sc.login_error, 'request_id')
@@ -314,11 +331,20 @@ def main():
     data = (sc.change_profile_section_succ, 'request_id')
     packed_info(data, 'Confirm a change in a profile')
 
-    data = (sc.friends_group_update, 'request_id',
+    # Notifications that are sent to a client at the same moment
+    # arrive in a single frame, one notification per line.
+    # If the client falls behind, queued notifications may be replaced
+    # with their bare codes (e.g. '10'): the client should then request
+    # the current state itself
+    data = (sc.friends_group_update,
     ['crypt_nick'],
     # online new
-    ['crypt_nick1'])
+    ['crypt_nick1'],
     # offline new
+    [['friends', 'crypt_nick2', True]],
+    # added to groups: friends, favorites, blacklist, incoming, outgoing
+    [['incoming', 'crypt_nick3']])
+    # removed from groups
     packed_info(data, 'Send an update of friends groups')
 
     data = (sc.add_to_blacklist_succ, 'request_id')
@@ -380,5 +406,11 @@ def main():
     data = (sc.set_image_succ, 'request_id')
     packed_info(data, 'Confirm setting the profile image')
 
+    data = (sc.sync_result, 'request_id', [['dialog'] + messages[0]],
+            ['dialog_with_more'])
+    packed_info(data, 'New messages from all dialogs')
+    # Only the first messages of a dialog are sent, the rest are
+    # fetched by the next sync for the dialogs in the last list
+
 if __name__ == '__main__':
     main()
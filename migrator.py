@@ -0,0 +1,119 @@
+from installer import Installer
+
+
+class Migrator(Installer):
+    """Переносит данные из базы, созданной предыдущими
+    версиями сервера, в текущую схему"""
+    sections = ('friends', 'favorites', 'blacklist', 'dialogs')
+
+    def table_exists(self, c, table):
+        c.execute('''SELECT table_name FROM information_schema.tables
+                     WHERE table_name = %s AND table_schema = 'public' ''',
+                  (table,))
+        return c.fetchone() is not None
+
+    def column_exists(self, c, table, column):
+        c.execute('''SELECT column_name FROM information_schema.columns
+                     WHERE table_name = %s AND column_name = %s
+                     AND table_schema = 'public' ''', (table, column))
+        return c.fetchone() is not None
+
+    def migrate_sessions(self):
+        """Добавляет в таблицу сессий столбцы сессионных ключей
+        и делает ее нежурналируемой
+        Возвращает True, если таблица стала нежурналируемой"""
+        c = self.db.cursor()
+        c.execute('''ALTER TABLE sessions
+                     ADD COLUMN IF NOT EXISTS sym_key bytea,
+                     ADD COLUMN IF NOT EXISTS mac_key bytea''')
+        c.execute('''SELECT relpersistence FROM pg_class
+                     WHERE relname = 'sessions' AND relkind = 'r'
+                     AND relnamespace = 'public'::regnamespace ''')
+        row = c.fetchone()
+        changed = row is not None and row[0] == 'p'
+        if changed:
+            c.execute('''ALTER TABLE sessions SET UNLOGGED''')
+        self.create_session_indexes(c)
+        self.db.commit()
+        c.close()
+        return changed
+
+    def migrate_relations(self):
+        """Переносит массивы friends, favorites, blacklist и dialogs
+        из таблицы users в таблицу relations и удаляет эти столбцы
+        Порядок элементов в каждом массиве сохраняется"""
+        c = self.db.cursor()
+        if not self.table_exists(c, 'relations'):
+            self.create_relations(c)
+
+        moved = 0
+        for sect in self.sections:
+            if not self.column_exists(c, 'users', sect):
+                continue
+            c.execute('''INSERT INTO relations (owner, kind, target)
+                         SELECT name, %s, item.target
+                         FROM users, unnest(users.{0}::text[])
+                              WITH ORDINALITY AS item(target, n)
+                         ORDER BY name, item.n
+                         ON CONFLICT DO NOTHING'''.format(sect), (sect,))
+            moved += c.rowcount
+            c.execute('''ALTER TABLE users DROP COLUMN {}'''.format(sect))
+
+        self.db.commit()
+        c.close()
+        return moved
+
+    def migrate_dialogs(self):
+        """Переносит сообщения из таблиц d{N} в общую таблицу messages
+        Каждый диалог переносится в отдельной транзакции, поэтому
+        прерванную миграцию можно запустить повторно"""
+        c = self.db.cursor()
+        if not self.table_exists(c, 'messages'):
+            self.create_messages(c)
+            self.db.commit()
+
+        c.execute('''SELECT table_name FROM information_schema.tables
+                     WHERE table_name ~ '^d[0-9]+$'
+                     AND table_schema = 'public' ''')
+        tables = [i[0] for i in c.fetchall()]
+
+        for table in tables:
+            dialog = int(table[1:])
+            c.execute('''INSERT INTO dialogs VALUES (%s)
+                         ON CONFLICT DO NOTHING''', (dialog,))
+            c.execute('''INSERT INTO messages (dialog, content,
+                                               timestamp, sender)
+                         SELECT %s, content, timestamp, sender FROM {}
+                         ORDER BY timestamp'''.format(table), (dialog,))
+            c.execute('''DROP TABLE {}'''.format(table))
+            self.db.commit()
+
+        if tables:
+            # Последовательность номеров диалогов продолжается
+            # после наибольшего перенесенного номера
+            c.execute('''SELECT setval(pg_get_serial_sequence('dialogs',
+                                                          'id'),
+                                        MAX(id) + 1, false)
+                         FROM dialogs''')
+            self.db.commit()
+
+        c.close()
+        return len(tables)
+
+    def migrate(self):
+        self.connect()
+        c = self.db.cursor()
+        self.create_request_indexes(c)
+        self.db.commit()
+        c.close()
+        if self.migrate_sessions():
+            print('Sessions table is now unlogged')
+        moved = self.migrate_relations()
+        print('Relations moved: {}'.format(moved))
+        moved = self.migrate_dialogs()
+        print('Dialogs moved: {}'.format(moved))
+        self.db.close()
+
+
+if __name__ == '__main__':
+    Migrator().migrate()
@@ -0,0 +1,115 @@
+import json, logging, os, uuid
+import psycopg2
+
+log = logging.getLogger('notify_bus')
+
+
+class LocalBus:
+    """Шина событий одного процесса: события не передаются никуда,
+    потому что все соединения клиентов обслуживает этот процесс"""
+    name = 'local'
+    # Передаются ли события другим процессам сервера
+    shared = False
+
+    def publish(self, db, event):
+        """Передает событие event (словарь, который можно
+        сериализовать в JSON) остальным процессам сервера"""
+
+    def listen(self, connect, callback, on_listen):
+        """Начинает принимать события других процессов через
+        соединение с базой данных, которое возвращает connect(),
+        вызывая для каждого события callback(event) в потоке цикла
+        событий
+        on_listen() вызывается после каждого подключения, чтобы
+        восстановить состояние, события которого могли быть пропущены"""
+
+
+class PostgresBus:
+    """Передает события между процессами сервера через LISTEN/NOTIFY
+    Событие отправляется в транзакции соединения, из которого
+    вызван publish, и доходит до других процессов после ее завершения"""
+    name = 'postgres'
+    shared = True
+    channel = 'chat_events'
+    # Предельный размер данных NOTIFY в байтах
+    max_payload = 7999
+
+    def __init__(self):
+        # Процесс пропускает собственные события
+        self.worker = uuid.uuid4().hex
+
+    def publish(self, db, event):
+        payload = json.dumps(dict(event, worker = self.worker),
+                             separators = (',', ':'))
+        users = event.get('users', ())
+        if len(payload.encode()) > self.max_payload and len(users) > 1:
+            # Длинный список получателей передается по частям
+            half = len(users) // 2
+            self.publish(db, dict(event, users = users[:half]))
+            self.publish(db, dict(event, users = users[half:]))
+            return
+        if len(payload.encode()) > self.max_payload:
+            # Ошибка NOTIFY прервала бы транзакцию запроса, поэтому
+            # слишком длинное событие не передается
+            log.warning('{} event is too large to publish: {} bytes'
+                        .format(event['type'], len(payload.encode())))
+            return
+        c = db.cursor()
+        c.execute('''SELECT pg_notify(%s, %s)''', (self.channel, payload))
+        c.close()
+
+    # Через сколько секунд повторяется подключение к базе данных,
+    # если соединение для LISTEN потеряно
+    retry_interval = 5
+
+    def listen(self, connect, callback, on_listen):
+        from tornado.ioloop import IOLoop
+
+        loop = IOLoop.current()
+        try:
+            db = connect()
+            db.autocommit = True
+            c = db.cursor()
+            c.execute('''LISTEN {}'''.format(self.channel))
+            c.close()
+        except psycopg2.OperationalError:
+            log.exception('failed to listen for events, retrying')
+            loop.call_later(self.retry_interval, self.listen,
+                            connect, callback, on_listen)
+            return
+
+        fd = db.fileno()
+
+        def on_notify(fd, events):
+            try:
+                db.poll()
+            except psycopg2.OperationalError:
+                # Соединение потеряно: подключаемся заново, а события,
+                # пропущенные до этого, восстанавливает on_listen
+                log.exception('lost connection for events, reconnecting')
+                loop.remove_handler(fd)
+                db.close()
+                loop.call_later(self.retry_interval, self.listen,
+                                connect, callback, on_listen)
+                return
+            while db.notifies:
+                event = json.loads(db.notifies.pop(0).payload)
+                if event.pop('worker') != self.worker:
+                    callback(event)
+
+        loop.add_handler(fd, on_notify, IOLoop.READ)
+        on_listen()
+
+
+BUSES = (LocalBus, PostgresBus)
+
+
+def get_bus(name = None):
+    """Возвращает шину событий с именем name ('local' или 'postgres')
+    По умолчанию берется NOTIFY_BUS, а если он не задан - local
+    Вызывает ValueError, если шины с именем name нет"""
+    name = name or os.getenv('NOTIFY_BUS', 'local')
+    for cls in BUSES:
+        if cls.name == name:
+            return cls()
+    raise ValueError('unknown notification bus: {}'.format(name))
@@ -0,0 +1,49 @@
+import threading
+
+
+class Presence:
+    """Реестр пользователей в сети, общий для всех потоков процесса
+    Для каждого пользователя хранятся IP-адреса его открытых сессий"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # IP-адреса сессий по именам пользователей
+        self.sessions = {}
+        # Имена пользователей по IP-адресам сессий
+        self.names = {}
+
+    def add(self, nick, ip):
+        """Отмечает, что пользователь nick открыл сессию с IP-адреса ip"""
+        with self.lock:
+            self._remove_ip(ip)
+            self.names[ip] = nick
+            self.sessions.setdefault(nick, set()).add(ip)
+
+    def remove(self, ip):
+        """Отмечает, что сессия с IP-адреса ip закрыта
+        Возвращает имя пользователя этой сессии или None"""
+        with self.lock:
+            return self._remove_ip(ip)
+
+    def _remove_ip(self, ip):
+        """Удаляет сессию с IP-адреса ip, вызывается под self.lock"""
+        nick = self.names.pop(ip, None)
+        if nick is not None:
+            ips = self.sessions[nick]
+            ips.discard(ip)
+            if not ips:
+                del self.sessions[nick]
+        return nick
+
+    def all(self):
+        """Возвращает пары (имя пользователя, IP-адрес) всех сессий"""
+        with self.lock:
+            return [(nick, ip) for ip, nick in self.names.items()]
+
+    def is_online(self, nick):
+        """Проверяет, есть ли у пользователя nick открытые сессии"""
+        return nick in self.sessions
+
+    def ips(self, nick):
+        """Возвращает IP-адреса открытых сессий пользователя nick"""
+        with self.lock:
+            return list(self.sessions.get(nick, ()))
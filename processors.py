@@ -1,12 +1,14 @@
-import psycopg2, psycopg2.extras
-import json, re, os, binascii
-import rsa, rsa.pkcs1, pyaes
+import psycopg2, psycopg2.extras, psycopg2.pool
+import json, re, os, threading
+import rsa
+import crypto
+import notify_bus, session_store
+from presence import Presence
 from urllib.parse import urlparse
 from datetime import datetime
 from hashlib import md5
 from random import randint
 from base64 import b64encode, b64decode
-from itertools import chain
 
 
 class BadRequest(Exception):
@@ -38,6 +40,7 @@ class ClientCodes():
     get_add_requests = 20
     decline_add_request = 21
     set_image = 22
+    sync = 23
 
 
 class ServerCodes():
@@ -72,6 +75,7 @@ class ServerCodes():
     add_requests = 27
     decline_add_request_succ = 28
     set_image_succ = 29
+    sync_result = 30
 
 
 cc = ClientCodes
@@ -82,21 +86,70 @@ class Processor:
     # Парсинг ссылки на базу данных
     url = urlparse(os.environ["DATABASE_URL"])
 
-    db = psycopg2.connect(database = url.path[1:],
-                          user = url.username,
-                          password = url.password,
-                          host = url.hostname,
-                          port = url.port,
-                          cursor_factory = psycopg2.extras.DictCursor)
+    # Число соединений с базой данных, которыми пользуются потоки,
+    # обрабатывающие запросы
+    pool_size = int(os.getenv('DB_POOL_SIZE', 8))
+
+    db_params = dict(database = url.path[1:],
+                     user = url.username,
+                     password = url.password,
+                     host = url.hostname,
+                     port = url.port,
+                     cursor_factory = psycopg2.extras.DictCursor)
+
+    # Еще одно соединение остается для потока цикла событий
+    pool = psycopg2.pool.ThreadedConnectionPool(1, pool_size + 1,
+                                                **db_params)
+
+    # Соединения, закрепленные за потоками
+    local = threading.local()
+
+    # Сколько новых сообщений одного диалога передается в ответ на sync
+    sync_limit = int(os.getenv('SYNC_LIMIT', 100))
+
+    # Пользователи в сети: подключенные к этому процессу, а при общей
+    # шине событий - и к остальным процессам сервера
+    presence = Presence()
+
+    # Шина событий между процессами сервера (NOTIFY_BUS):
+    # local - один процесс, postgres - LISTEN/NOTIFY
+    bus = notify_bus.get_bus()
+
+    # Группы, изменения которых передаются в friends_group_update
+    groups = ('friends', 'favorites', 'blacklist', 'incoming', 'outgoing')
+
+    # Хранилище сессий (SESSION_STORE): postgres - таблица sessions,
+    # memory - память процесса
+    sessions = session_store.get_store()
+
+    # Время последней активности сессий по IP-адресам, еще не
+    # записанное в хранилище сессий, и сколько сессий обновляется
+    # одним запросом
+    activity = {}
+    activity_lock = threading.Lock()
+    activity_chunk = 1000
+    # Сколько неактивных сессий удаляется одним запросом
+    reap_chunk = 1000
 
     # Получение приватного ключа
-    c = db.cursor()
+    key_db = pool.getconn()
+    c = key_db.cursor()
     c.execute('''SELECT * FROM key''')
     key_pair = c.fetchone()
     priv_key = rsa.PrivateKey(*list(map(int, key_pair['priv_key'])))
     pub_key_str = ':'.join(key_pair['pub_key'])
     c.close()
-    del c, key_pair
+    pool.putconn(key_db)
+    del c, key_pair, key_db
+
+    @property
+    def db(self):
+        """Соединение с базой данных, закрепленное за текущим потоком
+        При первом обращении из потока соединение берется из пула"""
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = self.pool.getconn()
+        return db
 
     # Регулярное выражение для валидации имен пользователей
     nick_ptrn = re.compile('(?![ ]+)[\w ]{2,15}')
@@ -108,92 +161,139 @@ class Processor:
     def _send_notification(self, user, code, conns):
         """Отправляет пользователю user уведомление с кодом code
         Если user не в сети, уведомления он не получает"""
-        ntf = str(code).encode()
-        c = self.db.cursor()
-        c.execute('''SELECT ip FROM sessions
-                     WHERE name = %s''', (user,))
-        row = c.fetchone()
-        if not row:
+        self._send_notifications((user,), code, conns)
+
+    def _send_notifications(self, users, code, conns, *data):
+        """Отправляет уведомление с кодом code и данными data
+        всем пользователям из users
+        Соединения находятся по реестру пользователей в сети без обращения
+        к базе данных; каждый получатель получает уведомление один раз
+        во все свои сессии
+        Получателям, подключенным к другим процессам сервера,
+        уведомление передается через шину событий"""
+        ntf = self._pack(code, *data)
+        remote = self._deliver(users, ntf, conns)
+        if remote:
+            self.bus.publish(self.db, {'type': 'notify',
+                                       'users': sorted(remote),
+                                       'data': ntf.decode()})
+
+    def _deliver(self, users, ntf, conns):
+        """Отправляет уведомление ntf пользователям из users через
+        соединения conns этого процесса
+        Возвращает пользователей, у которых есть сессии в других
+        процессах"""
+        remote = set()
+        for user in set(users):
+            for ip in self.presence.ips(user):
+                conn = conns.get(ip)
+                if conn:
+                    conn.notify(ntf)
+                else:
+                    remote.add(user)
+        return remote
+
+    def _receive(self, event, conns):
+        """Обрабатывает событие event, полученное от другого процесса
+        сервера через шину событий: уведомление пользователей
+        или открытие и закрытие сессии"""
+        if event['type'] == 'notify':
+            self._deliver(event['users'], event['data'].encode(), conns)
+        elif event['type'] == 'online':
+            self.presence.add(event['nick'], event['ip'])
+        elif event['type'] == 'offline':
+            self.presence.remove(event['ip'])
+
+    def _start_bus(self, conns):
+        """Начинает принимать события других процессов сервера,
+        доставляя уведомления через соединения conns
+        Вызывает ValueError, если сессии хранятся в памяти процесса,
+        а шина общая: сессии процесса, завершившегося аварийно,
+        тогда никогда не удалились бы из реестров остальных процессов
+        Вызывается из потока цикла событий"""
+        if not self.bus.shared:
             return
-        ip = row['ip']
-        if ip in conns:
-            conns[ip].write_message(ntf, binary = True)
-
-    def _get_public_key(self, ip):
-        """Получает публичный ключ для сессии, открытой с IP-адреса ip
-        Вызывает BadRequest, если нет сессий, открытых с этого IP-адреса"""
-        c = self.db.cursor()
-        c.execute('''SELECT pub_key FROM sessions
-                     WHERE ip = %s''', (ip,))
-        key = c.fetchone()
-        if not key:
+        if self.sessions.name == 'memory':
+            raise ValueError('SESSION_STORE=memory cannot be used with '
+                             'NOTIFY_BUS={}'.format(self.bus.name))
+        self.bus.listen(lambda: psycopg2.connect(**self.db_params),
+                        lambda event: self._receive(event, conns),
+                        lambda: self._sync_presence(conns))
+
+    def _sync_presence(self, conns):
+        """Приводит реестр пользователей в сети к хранилищу сессий:
+        события других процессов до подключения к шине событий
+        или во время потери соединения с ней пропущены
+        Сессии соединений conns этого процесса не удаляются"""
+        sessions = {ip: nick for nick, ip in self.sessions.all(self.db)}
+        self.db.commit()
+        for nick, ip in self.presence.all():
+            if ip not in sessions and ip not in conns:
+                self.presence.remove(ip)
+        for ip, nick in sessions.items():
+            self.presence.add(nick, ip)
+
+    def _send_update(self, users, conns, online = (), offline = (),
+                     added = (), removed = ()):
+        """Отправляет пользователям users изменения их групп друзей:
+        online - вошедшие в сеть, offline - вышедшие из сети,
+        added - добавленные в группы пары [группа, имя, в сети ли],
+        removed - удаленные из групп пары [группа, имя]
+        Группы: friends, favorites, blacklist, а также incoming и
+        outgoing для входящих и исходящих запросов на добавление"""
+        self._send_notifications(users, sc.friends_group_update, conns,
+                                 list(online), list(offline),
+                                 list(added), list(removed))
+
+    def _parse_public_key(self, pub_key):
+        """Возвращает rsa.PublicKey из строки pub_key вида 'n:e'
+        Вызывает BadRequest, если строка имеет неверный формат"""
+        try:
+            n, e = map(int, pub_key.split(':'))
+        except (AttributeError, ValueError):
             raise BadRequest
-        n, e = key['pub_key']
-        pub_key = rsa.PublicKey(int(n), int(e))
-        return pub_key
+        return rsa.PublicKey(n, e)
 
     def _decrypt(self, request, enc_key):
         """Расшифровывает байт-строку request в base64 через ключ enc_key
         Вызывает BadRequest, если расшифровать строку не удалось"""
         try:
-            decoded_request = b64decode(request)
-            decoded_key = b64decode(enc_key)
-            key = rsa.decrypt(decoded_key, self.priv_key)
-        except (rsa.pkcs1.DecryptionError, binascii.Error):
+            return crypto.decrypt(request, enc_key, self.priv_key)
+        except crypto.CryptoError:
             raise BadRequest
 
-        aes = pyaes.AESModeOfOperationCTR(key)
-        decrypted = aes.decrypt(decoded_request)
-
-        return decrypted
-
     def _encrypt(self, response, pub_key):
         """Зашифровывает байт-строку response AES-шифрованием, а ключ
         шифрует публичным ключом клиента pub_key"""
-        key = os.urandom(32)
-        aes = pyaes.AESModeOfOperationCTR(key)
-        enc_response = aes.encrypt(response)
-        enc_key = rsa.encrypt(key, pub_key)
-
-        return b64encode(enc_response) + b':' + b64encode(enc_key)
+        return crypto.encrypt(response, pub_key)
 
     def _verify_signature(self, request, signature, pub_key):
         """Проверяет подлинность подписи signature байт-строки request в base64
         публичным ключом pub_key
         Вызывает BadRequest, если проверка не пройдена"""
-        decoded_request = b64decode(request)
         try:
-            rsa.verify(decoded_request, signature, pub_key)
-        except rsa.pkcs1.VerificationError:
+            crypto.verify(request, signature, pub_key)
+        except crypto.CryptoError:
             raise BadRequest
 
-    def _add_session(self, nick, pub_key, ip):
+    def _add_session(self, nick, pub_key, ip, sym_key = None, mac_key = None):
         """Добавляет пользователя nick по IP-адресу ip
-        с публичным ключом pub_key в таблицу сессий
-        Вызывает BadRequest, если запись с таким публичным
-        ключом уже есть в таблице"""
-        c = self.db.cursor()
-
-        try:
-            with self.db:
-                c.execute('''INSERT INTO sessions
-                             VALUES (%s, %s, %s)''',
-                          (nick, pub_key.split(':'), ip))
-        except psycopg2.IntegrityError:
+        с публичным ключом pub_key и сессионными ключами sym_key
+        (шифрование) и mac_key (аутентификация) в хранилище сессий
+        Вызывает BadRequest, если сессия с IP-адреса ip уже открыта"""
+        if not self.sessions.add(self.db, nick, pub_key.split(':'), ip,
+                                 int(datetime.now().timestamp()),
+                                 sym_key, mac_key):
             raise BadRequest
-        c.close()
+        self.presence.add(nick, ip)
+        self.bus.publish(self.db, {'type': 'online', 'nick': nick, 'ip': ip})
 
-    def _get_nick(self, ip):
-        """Возвращает имя пользователя, чья сессия открыта с IP-адреса ip
-        Вызывает BadRequest, если такой записи нет"""
-        c = self.db.cursor()
-        c.execute('''SELECT name FROM sessions
-                     WHERE ip = %s''', (ip,))
-        nick = c.fetchone()
-        c.close()
-        if nick:
-            return nick['name']
-        raise BadRequest
+    def _session_nick(self, session):
+        """Возвращает имя пользователя, вошедшего в сессии session
+        Вызывает BadRequest, если пользователь не входил в систему"""
+        if not session.logged_in:
+            raise BadRequest
+        return session.nick
 
     def _pack(self, *data):
         """Собирает данные data в формат для передачи
@@ -201,45 +301,75 @@ class Processor:
         return json.dumps(data, separators = (',', ':'))[1:-1].encode()
 
     def _close_session(self, ip):
-        """Удаляет из таблицы сессий запись, открытую с IP-адреса ip"""
-        c = self.db.cursor()
-        with self.db:
-            c.execute('''DELETE FROM sessions
-                         WHERE ip = %s''', (ip,))
-
-        c.close()
+        """Удаляет из хранилища сессий сессию, открытую с IP-адреса ip"""
+        self.sessions.remove(self.db, ip)
+        self.presence.remove(ip)
+        self.bus.publish(self.db, {'type': 'offline', 'ip': ip})
 
     def _remove_from(self, nick, item, sect):
-        """Удаляет элемент item из графы sect в записи с именем nick
+        """Удаляет элемент item из графы sect пользователя nick
         Вызывает BadRequest, если пользователь nick не найден
         """
         c = self.db.cursor()
-        c.execute('''SELECT {}::text[] FROM users
-                     WHERE name = %s'''.format(sect), (nick,))
-
-        prev = c.fetchone()
-        if not prev:
-            raise BadRequest
-        data = prev[sect]
-        try:
-            data.remove(item)
-        except ValueError:
-            pass  # Если элемента нет, проигнорировать исключение
         with self.db:
-            c.execute('''UPDATE users SET {} = %s
-                         WHERE name = %s'''.format(sect), (data, nick))
+            c.execute('''DELETE FROM relations
+                         WHERE owner = %s AND kind = %s AND target = %s''',
+                      (nick, sect, item))
+        if not c.rowcount:
+            # Если элемента нет, удалять нечего,
+            # но пользователь nick должен существовать
+            self._user_exists(nick)
+
+        c.close()
 
+    def _in_section(self, nick, item, *sects):
+        """Проверяет, есть ли элемент item в одной из граф sects
+        пользователя nick"""
+        c = self.db.cursor()
+        c.execute('''SELECT owner FROM relations
+                     WHERE owner = %s AND kind = ANY(%s) AND target = %s''',
+                  (nick, list(sects), item))
+        found = c.fetchone() is not None
+        c.close()
+        return found
+
+    def _get_section(self, nick, sect):
+        """Возвращает элементы графы sect пользователя nick
+        в порядке добавления"""
+        c = self.db.cursor()
+        c.execute('''SELECT target FROM relations
+                     WHERE owner = %s AND kind = %s
+                     ORDER BY id''', (nick, sect))
+        items = [i['target'] for i in c.fetchall()]
         c.close()
+        return items
 
     def _is_blacklisted(self, nick, user):
         """Проверяет, находится ли nick в черном списке user"""
-        c = self.db.cursor()
         if nick == user:
             return False
-        c.execute('''SELECT name FROM users
-                     WHERE name = %s AND %s = ANY(blacklist::text[])''',
-                  (user, nick))
-        return bool(c.fetchone())
+        return self._in_section(user, nick, 'blacklist')
+
+    def _related_users(self, nick):
+        """Возвращает пользователей, которым нужно сообщать об изменениях
+        статуса nick: его друзей, тех, кто добавил его в черный список,
+        и тех, с кем у него есть запросы на добавление"""
+        c = self.db.cursor()
+        c.execute('''SELECT target AS name FROM relations
+                     WHERE owner = %(nick)s AND kind = 'friends'
+                     UNION
+                     SELECT owner FROM relations
+                     WHERE target = %(nick)s AND
+                     kind IN ('friends', 'blacklist')
+                     UNION
+                     SELECT to_who FROM requests
+                     WHERE from_who = %(nick)s
+                     UNION
+                     SELECT from_who FROM requests
+                     WHERE to_who = %(nick)s''', {'nick': nick})
+        users = [i['name'] for i in c.fetchall()]
+        c.close()
+        return users
 
     def _remove_add_request(self, nick, user):
         """Удаляет запрос от nick к user"""
@@ -252,24 +382,18 @@ class Processor:
         c.close()
 
     def _add_to(self, nick, item, sect):
-        """Добавляет элемент item к графе sect в записи с именем nick
+        """Добавляет элемент item к графе sect пользователя nick
         Вызывает BadRequest, если пользователь nick не найден"""
         c = self.db.cursor()
-
-        c.execute('''SELECT {}::text[] FROM users
-                     WHERE name = %s'''.format(sect), (nick,))
-
-        prev = c.fetchone()
-        if not prev:
-            raise BadRequest
-        data = prev[sect]
-        if item in data:
-            return  # Если элемент уже есть, не добавлять его еще раз
-        data.append(item)
         with self.db:
-            c.execute('''UPDATE users SET {} = %s
-                         WHERE name = %s'''.format(sect),
-                      (data, nick))
+            c.execute('''INSERT INTO relations (owner, kind, target)
+                         SELECT name, %s, %s FROM users
+                         WHERE name = %s
+                         ON CONFLICT DO NOTHING''', (sect, item, nick))
+        if not c.rowcount:
+            # Если элемент уже есть, он не добавляется еще раз,
+            # но пользователь nick должен существовать
+            self._user_exists(nick)
 
         c.close()
 
@@ -278,13 +402,14 @@ class Processor:
         Вызывает BadRequest, если собеседника нет"""
         c = self.db.cursor()
 
-        c.execute('''SELECT name FROM users
-                     WHERE name != %s AND %s = ANY(dialogs::text[])''',
-                  (nick, str(dialog)))
+        c.execute('''SELECT owner FROM relations
+                     WHERE target = %s AND kind = 'dialogs' AND
+                     owner != %s''', (str(dialog), nick))
         row = c.fetchone()
+        c.close()
         if not row:
             return None
-        return row['name']
+        return row['owner']
 
     def _user_in_dialog(self, user, dialog):
         """Проверяет, что диалог под номером dialog есть
@@ -293,30 +418,29 @@ class Processor:
         диалога dialog нет в графе или dialog не является целым числом"""
         if not isinstance(dialog, int):
             raise BadRequest
-        c = self.db.cursor()
-        c.execute('''SELECT dialogs FROM users
-                     WHERE name = %s AND %s = ANY(dialogs::text[])''',
-                  (user, str(dialog)))
-        if not c.fetchone():
+        if not self._in_section(user, str(dialog), 'dialogs'):
             raise BadRequest
 
-        c.close()
-
     def _delete_dialog(self, dialog, user):
         """Удаляет диалог под номером dialog по запросу пользователя user
-        Если собеседник удалил для себя этот диалог, таблица диалога удаляется.
+        Если собеседник удалил для себя этот диалог, диалог и все его
+        сообщения удаляются.
         Иначе пользователь, от кого поступил запрос на удаление,
         помечается как удаливший этот диалог для себя"""
         c = self.db.cursor()
-        c.execute('''SELECT sender FROM d{}
-                     WHERE sender != %s'''.format(dialog), (user,))
+        c.execute('''SELECT sender FROM messages
+                     WHERE dialog = %s AND sender != %s
+                     LIMIT 1''', (dialog, user))
         sender = c.fetchone()
         if not sender or sender['sender'][0] == '~':
-            c.execute('''DROP TABLE d{}'''.format(dialog))
+            c.execute('''DELETE FROM messages
+                         WHERE dialog = %s''', (dialog,))
+            c.execute('''DELETE FROM dialogs
+                         WHERE id = %s''', (dialog,))
         else:
-            c.execute('''UPDATE d{} SET sender = '~' || %s
-                         WHERE sender = %s'''.format(dialog),
-                      (user, user))
+            c.execute('''UPDATE messages SET sender = '~' || %s
+                         WHERE dialog = %s AND sender = %s''',
+                      (user, dialog, user))
         # Диалог с номером dialog удаляется из диалогов пользователя user
         self._remove_from(user, str(dialog), 'dialogs')
         self.db.commit()
@@ -339,119 +463,148 @@ class Processor:
         return bool(re.fullmatch(self.nick_ptrn, nick))
 
     def _next_free_dialog(self):
-        """Возвращает следующий свободный номер диалога"""
+        """Возвращает следующий свободный номер диалога
+        Номера выдаются последовательностью, поэтому два одновременных
+        запроса никогда не получат один и тот же номер"""
         c = self.db.cursor()
-        c.execute('''SELECT table_name FROM information_schema.tables
-                     WHERE table_schema = 'public' ''')
-        dialogs = sorted(int(i['table_name'][1:]) for i in c.fetchall()
-                         if i['table_name'][0] == 'd')
-        # Здесь из всех таблиц, названия которых начинаются с 'd', будет взят
-        # номер, и полученный список номеров будет отсортирован
+        c.execute('''SELECT nextval(pg_get_serial_sequence('dialogs', 'id'))
+                     AS id''')
+        dialog = c.fetchone()['id']
         c.close()
-        if not dialogs:
-            # Если еще нет диалогов
-            return 1
-
-        for i in range(1, len(dialogs)):
-            if dialogs[i] - dialogs[i - 1] != 1:
-                return dialogs[i - 1] + 1
-        return dialogs[-1] + 1
+        return dialog
 
     def _set_timestamp(self, address):
-        """Сохраняет текущую дату в last_active
-        таблицы sessions"""
-        c = self.db.cursor()
-        stamp = datetime.now().timestamp()
-        c.execute('''UPDATE sessions SET last_active = %s
-                     WHERE ip = %s''', (int(stamp), address))
-
-        c.close()
+        """Запоминает текущую дату как время последней активности
+        сессии с IP-адреса address
+        В хранилище сессий она попадает
+        при следующем вызове _flush_timestamps"""
+        stamp = int(datetime.now().timestamp())
+        with self.activity_lock:
+            self.activity[address] = stamp
+
+    def _flush_timestamps(self):
+        """Записывает накопленные даты активности сессий
+        в хранилище сессий
+        Возвращает число обновленных сессий"""
+        with self.activity_lock:
+            activity = list(self.activity.items())
+            self.activity.clear()
+        if not activity:
+            return 0
+        return self.sessions.touch(self.db, activity, self.activity_chunk)
+
+    def _end_transaction(self):
+        """Завершает транзакцию соединения текущего потока, чтобы оно
+        не удерживало блокировки, пока поток ждет следующий запрос"""
+        self.db.commit()
 
-    def _clean_up(self, address):
+    def _clean_up(self, address, conns = None):
         """Закрывает все сессии с address на случай аварийного закрытия
-        соединения клиентом"""
-        c = self.db.cursor()
-        c.execute('''DELETE FROM sessions
-                     WHERE ip = %s''', (address,))
-        c.close()
-        self.db.commit()
+        соединения клиентом
+        Если это была последняя сессия пользователя, связанные с ним
+        пользователи получают уведомление через соединения conns"""
+        self.sessions.remove(self.db, address)
+        self._forget_sessions([address], conns)
+
+    def _reap_sessions(self, before, conns = None):
+        """Удаляет сессии, последняя активность которых была раньше
+        before, частями по reap_chunk сессий
+        Пользователи, у которых не осталось сессий, уведомляются как
+        в _clean_up
+        Возвращает IP-адреса удаленных сессий"""
+        reaped = self.sessions.reap(self.db, before, self.reap_chunk)
+        self._forget_sessions(reaped, conns)
+        return reaped
+
+    def _forget_sessions(self, ips, conns = None):
+        """Убирает закрытые сессии с IP-адресов ips из реестра
+        пользователей в сети
+        Если у пользователя не осталось сессий, связанные с ним
+        пользователи получают уведомление через соединения conns"""
+        offline = set()
+        for ip in ips:
+            nick = self.presence.remove(ip)
+            if nick is not None:
+                offline.add(nick)
+                self.bus.publish(self.db, {'type': 'offline', 'ip': ip})
+        if conns is None:
+            return
+        for nick in offline:
+            if not self.presence.is_online(nick):
+                self._send_update(self._related_users(nick), conns,
+                                  offline = [nick])
 
-    def register(self, request_id, ip, nick, pswd, pub_key):
+    def register(self, request_id, session, nick, pswd, pub_key):
         """Зарегистрироваться с именем nick, хэшем pswd пароля
-        и публичным ключом pub_key"""
+        и публичным ключом pub_key
+        В ответе передаются сессионные ключи для следующих запросов"""
         with open('avatar_placeholder.png', 'rb') as f:
             img = f.read()
 
+        key = self._parse_public_key(pub_key)
         if not self._valid_nick(nick):
-            return self._pack(sc.register_error, request_id)
+            return self._pack(sc.register_error, request_id), key
 
         c = self.db.cursor()
 
         try:
             with self.db:
                 c.execute('''INSERT INTO users
-                             VALUES (%s, %s,
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''',
-                          (nick, pswd))
+                             VALUES (%s, %s)''', (nick, pswd))
 
                 c.execute('''INSERT INTO profiles
                              VALUES (%s, '', '', 0, '', %s)''', (nick, img))
         except psycopg2.IntegrityError:
             # Если пользователь с таким именем существует
-            return self._pack(sc.register_error, request_id)
+            return self._pack(sc.register_error, request_id), key
 
-        self._add_session(nick, pub_key, ip)
+        sym_key = crypto.new_session_key()
+        mac_key = crypto.new_session_key()
+        self._add_session(nick, pub_key, session.ip, sym_key, mac_key)
+        session.open(nick, key, sym_key, mac_key)
 
         c.close()
-        return self._pack(sc.register_succ, request_id)
+        return self._pack(sc.register_succ, request_id,
+                          b64encode(sym_key).decode(),
+                          b64encode(mac_key).decode())
 
-    def login(self, request_id, ip, nick, pswd, pub_key, conns):
+    def login(self, request_id, session, nick, pswd, pub_key, conns):
         """Войти в систему с именем nick, хэшем pswd пароля
-        и публичным ключом pub_key"""
+        и публичным ключом pub_key
+        В ответе передаются сессионные ключи для следующих запросов"""
+        key = self._parse_public_key(pub_key)
         c = self.db.cursor()
-        c.execute('''SELECT name, friends FROM users
+        c.execute('''SELECT name FROM users
                      WHERE name = %s AND password = %s''', (nick, pswd))
         row = c.fetchone()
         if not row:
             # Если такой комбинации имени-пароля нет
-            return (self._pack(sc.login_error, request_id),
-                    rsa.PublicKey(*list(map(int, pub_key.split(':')))))
-
-        friends = row['friends']
-
-        c.execute('''SELECT name FROM users
-                     WHERE %s = ANY(blacklist::text[])''', (nick,))
-        in_bl = [row['name'] for row in c.fetchall()]
-
-        c.execute('''SELECT to_who FROM requests
-                     WHERE from_who = %s''', (nick,))
-        outc = [row['to_who'] for row in c.fetchall()]
-
-        c.execute('''SELECT from_who FROM requests
-                     WHERE to_who = %s''', (nick,))
-        inc = [row['from_who'] for row in c.fetchall()]
-
-        for i in chain(friends, in_bl, outc, inc):
-            self._send_notification(i, sc.friends_group_update, conns)
+            return self._pack(sc.login_error, request_id), key
 
+        was_online = self.presence.is_online(nick)
+        sym_key = crypto.new_session_key()
+        mac_key = crypto.new_session_key()
         try:
-            self._add_session(nick, pub_key, ip)
+            self._add_session(nick, pub_key, session.ip, sym_key, mac_key)
         except BadRequest:
-            return (self._pack(sc.login_error, request_id),
-                    rsa.PublicKey(*list(map(int, pub_key.split(':')))))
+            return self._pack(sc.login_error, request_id), key
 
+        if not was_online:
+            # Пользователь вошел в сеть первой сессией
+            self._send_update(self._related_users(nick), conns,
+                              online = [nick])
+
+        session.open(nick, key, sym_key, mac_key)
         c.close()
-        return self._pack(sc.login_succ, request_id)
+        return self._pack(sc.login_succ, request_id,
+                          b64encode(sym_key).decode(),
+                          b64encode(mac_key).decode())
 
-    def search_list(self, request_id, ip):
+    def search_list(self, request_id, session):
         """Получить список всех пользователей и их статусов для поиска"""
         c = self.db.cursor()
-        nick = self._get_nick(ip)
-        c.execute('''SELECT name FROM sessions''')
-        online = set(row['name'] for row in c.fetchall())
+        nick = self._session_nick(session)
+        online = self.presence.is_online
 
         c.execute('''SELECT from_who FROM requests
                      WHERE to_who = %s''', (nick,))
@@ -461,64 +614,144 @@ class Processor:
         outc = set(row['to_who'] for row in c.fetchall())
 
         c.execute('''SELECT name FROM users
-                     WHERE name != %s AND
-                     (%s != ANY(blacklist::text[]) OR blacklist = '{}') AND
-                     (%s != ANY(friends::text[]) OR friends = '{}')''', (nick, nick, nick))
+                     WHERE name != %s AND NOT EXISTS
+                     (SELECT owner FROM relations
+                      WHERE owner = users.name AND target = %s AND
+                      kind IN ('friends', 'blacklist'))''', (nick, nick))
         user_list = []
         for row in c.fetchall():
             name = row['name']
             if name not in inc and name not in outc:
-                user_list.append((name, name in online))
+                user_list.append((name, online(name)))
 
         c.close()
         return self._pack(sc.search_list, request_id, user_list)
 
-    def friends_group(self, request_id, ip):
+    def friends_group(self, request_id, session):
         """Получить список друзей, сгрупированных в списки:
         онлайн, оффлайн, избранные, заблокированные"""
-        c = self.db.cursor()
-        nick = self._get_nick(ip)
-        c.execute('''SELECT friends::text[],
-                            favorites::text[],
-                            blacklist::text[]
-                     FROM users WHERE name = %s''', (nick,))
-        friends, fav, bl = c.fetchone()
-
-        c.execute('''SELECT name FROM sessions''')
-        online_all = {i['name'] for i in c.fetchall()}
+        nick = self._session_nick(session)
+        friends = self._get_section(nick, 'friends')
+        fav = self._get_section(nick, 'favorites')
+        bl = self._get_section(nick, 'blacklist')
 
+        is_online = self.presence.is_online
         online = []
         offline = []
         for i in friends:
-            if i in online_all:
+            if is_online(i):
                 online.append((i, True))
             else:
                 offline.append((i, False))
 
-        fav = [(name, name in online_all) for name in fav]
-        bl = [(name, name in online_all) for name in bl]
-        c.close()
+        fav = [(name, is_online(name)) for name in fav]
+        bl = [(name, is_online(name)) for name in bl]
         return self._pack(sc.friends_group_response, request_id,
                           [fav, online, offline, bl])
 
-    def message_history(self, request_id, ip, count, dialog):
+    def message_history(self, request_id, session, count, dialog,
+                        before_id = None, after_id = None):
         """Получить count последних сообщений из диалога dialog
         Если count = 0, возвращает все сообщения
-        Вызывает BadRequest, если count < 0"""
-        c = self.db.cursor()
+        Если указан before_id, возвращаются count сообщений, предшествующих
+        сообщению before_id, если after_id - count сообщений, следующих
+        за сообщением after_id
+        Сообщения упорядочены по номеру, то есть по времени поступления
+        на сервер
+        Вызывает BadRequest, если count < 0 или before_id или after_id
+        не является целым числом"""
         if count < 0:
             raise BadRequest
+        for msg_id in (before_id, after_id):
+            if msg_id is not None and not isinstance(msg_id, int):
+                raise BadRequest
 
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         self._user_in_dialog(nick, dialog)
 
-        c.execute('''SELECT * FROM d{}
-                     ORDER BY timestamp'''.format(dialog))
-        msgs = [tuple(i) for i in c.fetchall()]
+        query = '''SELECT id, content, timestamp, sender FROM messages
+                   WHERE dialog = %(dialog)s AND
+                   (%(before)s IS NULL OR id < %(before)s) AND
+                   (%(after)s IS NULL OR id > %(after)s)'''
+        args = {'dialog': dialog, 'before': before_id,
+                'after': after_id, 'count': count or None}
+        if count and after_id is None:
+            # Берутся count последних сообщений (перед before_id)
+            c = self.db.cursor()
+            c.execute(query + ' ORDER BY id DESC LIMIT %(count)s', args)
+            msgs = [tuple(i) for i in c.fetchall()]
+            msgs.reverse()
+        else:
+            # Берутся count первых сообщений после after_id
+            # или, если count = 0, вся история
+            c = self.db.cursor()
+            c.execute(query + ' ORDER BY id LIMIT %(count)s', args)
+            msgs = [tuple(i) for i in c.fetchall()]
         c.close()
-        return self._pack(sc.message_history, request_id, msgs[-count:])
+        return self._pack(sc.message_history, request_id, msgs)
+
+    def sync(self, request_id, session, watermarks):
+        """Получить одним запросом новые сообщения из всех диалогов
+        отправителя
+        watermarks - номер последнего полученного сообщения, общий для всех
+        диалогов, или словарь {номер диалога: номер последнего полученного
+        сообщения}. Для диалогов, которых нет в словаре, номером последнего
+        полученного сообщения считается 0
+        Из каждого диалога передается не больше sync_limit первых новых
+        сообщений, а номера диалогов, в которых остались непереданные
+        сообщения, возвращаются отдельным списком: их клиент получает
+        следующим запросом sync или message_history с after_id
+        Каждое сообщение передается вместе с номером своего диалога
+        Вызывает BadRequest, если watermarks имеет неверный формат"""
+        if isinstance(watermarks, int):
+            default, dialogs, marks = watermarks, [], []
+        elif isinstance(watermarks, dict):
+            try:
+                dialogs = list(map(int, watermarks))
+            except ValueError:
+                raise BadRequest
+            marks = list(watermarks.values())
+            if not all(isinstance(i, int) for i in marks):
+                raise BadRequest
+            default = 0
+        else:
+            raise BadRequest
+
+        nick = self._session_nick(session)
+        c = self.db.cursor()
+        # Лишнее сообщение из каждого диалога показывает,
+        # что в нем остались непереданные сообщения
+        c.execute('''SELECT m.dialog, m.id, m.content, m.timestamp, m.sender
+                     FROM relations r
+                     LEFT JOIN unnest(%s::integer[], %s::bigint[])
+                               AS w(dialog, mark)
+                     ON w.dialog = r.target::integer
+                     CROSS JOIN LATERAL
+                     (SELECT dialog, id, content, timestamp, sender
+                      FROM messages
+                      WHERE dialog = r.target::integer AND
+                      id > COALESCE(w.mark, %s)
+                      ORDER BY id
+                      LIMIT %s) m
+                     WHERE r.owner = %s AND r.kind = 'dialogs'
+                     ORDER BY m.dialog, m.id''',
+                  (dialogs, marks, default, self.sync_limit + 1, nick))
+        msgs = []
+        more = []
+        dialog = None
+        for row in c.fetchall():
+            if row['dialog'] != dialog:
+                dialog, count = row['dialog'], 0
+            count += 1
+            if count <= self.sync_limit:
+                msgs.append(tuple(row))
+            else:
+                more.append(dialog)
+
+        c.close()
+        return self._pack(sc.sync_result, request_id, msgs, more)
 
-    def send_message(self, request_id, ip, msg, tm, dialog, conns):
+    def send_message(self, request_id, session, msg, tm, dialog, conns):
         """Отправить сообщение msg с временем tm в диалог под номером dialog
         Вызывает BadRequest, если отправитель находится в черном списке
         собеседника или длина сообщения превышает 1000 символов"""
@@ -527,7 +760,7 @@ class Processor:
         max_msg_length = 1000
         if len(msg) > max_msg_length:
             raise BadRequest
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         self._user_in_dialog(nick, dialog)
 
         user = self._get_collocutor(dialog, nick)
@@ -536,22 +769,23 @@ class Processor:
 
         c = self.db.cursor()
         with self.db:
-            c.execute('''INSERT INTO d{}
-                         VALUES (%s, %s, %s)'''.format(dialog),
-                      (msg, tm, nick))
+            c.execute('''INSERT INTO messages (dialog, content,
+                                               timestamp, sender)
+                         VALUES (%s, %s, %s, %s)''',
+                      (dialog, msg, tm, nick))
 
-        if not user:
+        if user:
             self._send_notification(user, sc.new_message, conns)
 
         c.close()
         return self._pack(sc.message_received, request_id)
 
-    def change_profile_section(self, request_id, ip, sect, change):
+    def change_profile_section(self, request_id, session, sect, change):
         """Заменить секцию профиля sect на change
         Вызывает BadRequest, если дата рождения (секция 2)
         меняется на что-то кроме целого числа
         или указана несуществующая секция"""
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
 
         birthday = 2
         if not isinstance(change, int) and sect == birthday:
@@ -575,10 +809,10 @@ class Processor:
         c.close()
         return self._pack(sc.change_profile_section_succ, request_id)
 
-    def add_to_blacklist(self, request_id, ip, user, conns):
+    def add_to_blacklist(self, request_id, session, user, conns):
         """Добавить пользователя user в черный список
         Вызывает BadRequest, если отправитель пытается добавить себя"""
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         self._user_exists(user)
         if nick == user:
             raise BadRequest
@@ -588,42 +822,39 @@ class Processor:
         self._remove_add_request(nick, user)
         self._remove_add_request(user, nick)
 
-        self._send_notification(user, sc.friends_group_update, conns)
+        self._send_update([user], conns,
+                          removed = [['incoming', nick], ['outgoing', nick]])
 
         return self._pack(sc.add_to_blacklist_succ, request_id)
 
-    def delete_from_friends(self, request_id, ip, user, conns):
+    def delete_from_friends(self, request_id, session, user, conns):
         """Удалить пользователя user из друзей"""
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         self._user_exists(user)
         self._remove_from(nick, user, 'friends')
         self._remove_from(nick, user, 'favorites')
         self._remove_from(user, nick, 'friends')
         self._remove_from(user, nick, 'favorites')
 
-        self._send_notification(user, sc.friends_group_update, conns)
+        self._send_update([user], conns,
+                          removed = [['friends', nick], ['favorites', nick]])
 
         return self._pack(sc.delete_from_friends_succ, request_id)
 
-    def send_request(self, request_id, ip, user, msg, conns):
+    def send_request(self, request_id, session, user, msg, conns):
         """Отправить пользователю user запрос на добавление с сообщением msg
         Вызывает BadRequest, если уже отправлен запрос этому пользователю
         или отправитель пытается отправить запрос на добавление себе
         или тому, в чьем черном списке или друзьях он находится"""
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         self._user_exists(user)
         if nick == user:
             raise BadRequest
 
-        c = self.db.cursor()
-        c.execute('''SELECT name FROM users
-                     WHERE name = %s AND
-                     (%s = ANY(friends::text[]) OR
-                      %s = ANY(blacklist::text[]))''',
-                  (user, nick, nick))
-        if c.fetchone():
+        if self._in_section(user, nick, 'friends', 'blacklist'):
             raise BadRequest
 
+        c = self.db.cursor()
         c.execute('''SELECT from_who FROM requests
                      WHERE from_who = %s AND to_who = %s OR
                      from_who = %s AND to_who = %s''', (user, nick,
@@ -635,88 +866,84 @@ class Processor:
             c.execute('''INSERT INTO requests
                          VALUES (%s, %s, %s)''', (nick, user, msg))
 
-        self._send_notification(user, sc.friends_group_update, conns)
+        self._send_update([user], conns, added = [['incoming', nick, True]])
 
         c.close()
         return self._pack(sc.send_request_succ, request_id)
 
-    def delete_profile(self, request_id, ip, conns):
+    def delete_profile(self, request_id, session, conns):
         """Удалить свой профиль"""
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         nick_tuple = (nick,)
         c = self.db.cursor()
-        c.execute('''SELECT friends::text[], dialogs::text[] FROM users
-                     WHERE name = %s ''', nick_tuple)
-        friends, messages = c.fetchone()
+        messages = self._get_section(nick, 'dialogs')
+        related = self._related_users(nick)
 
         c.execute('''DELETE FROM requests
                      WHERE from_who = %s OR to_who = %s''', nick_tuple * 2)
 
-        self._close_session(ip)
-
-        for i in friends:
-            self._remove_from(i, nick, 'friends')
-            self._remove_from(i, nick, 'favorites')
+        self._close_session(session.ip)
+        session.close()
 
         for i in messages:
             self._delete_dialog(int(i), nick)
 
+        # Пользователь удаляется из друзей, избранных и черных списков.
+        # Его собственные связи удаляются вместе с записью в users
+        c.execute('''DELETE FROM relations
+                     WHERE target = %s AND
+                     kind IN ('friends', 'favorites', 'blacklist')''',
+                  nick_tuple)
         c.execute('''DELETE FROM profiles
                      WHERE name = %s''', nick_tuple)
         c.execute('''DELETE FROM users
                      WHERE name = %s''', nick_tuple)
 
-        c.execute('''SELECT name FROM users''')
-        for i in c.fetchall():
-            self._remove_from(i['name'], nick, 'blacklist')
-            self._send_notification(i['name'], sc.friends_group_update, conns)
-
         self.db.commit()
         c.close()
+
+        self._send_update(related, conns, offline = [nick],
+                          removed = [[i, nick] for i in self.groups])
         return self._pack(sc.delete_profile_succ, request_id)
 
-    def logout(self, request_id, ip, conns):
+    def logout(self, request_id, session, conns):
         """Выйти из системы"""
-        self._close_session(ip)
-        c = self.db.cursor()
-        c.execute('''SELECT name FROM users''')
-        for i in c.fetchall():
-            self._send_notification(i['name'], sc.friends_group_update, conns)
+        nick = self._session_nick(session)
+        self._close_session(session.ip)
+        session.close()
+        if not self.presence.is_online(nick):
+            # Закрыта последняя сессия пользователя
+            self._send_update(self._related_users(nick), conns,
+                              offline = [nick])
 
         return self._pack(sc.logout_succ, request_id)
 
-    def create_dialog(self, request_id, ip, user):
+    def create_dialog(self, request_id, session, user):
         """Создать диалог с пользователем user
         Вызывает BadRequest, если пользователь user
         не находится в друзьях или черном списке отправителя"""
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         self._user_exists(user)
 
-        c = self.db.cursor()
-        c.execute('''SELECT name FROM users
-                     WHERE name = %s AND (%s = ANY(friends::text[])
-                     OR %s = ANY(blacklist::text[]))''',
-                  (nick, user, user))
-        if not c.fetchone():
+        if not self._in_section(nick, user, 'friends', 'blacklist'):
             raise BadRequest
 
-        c.execute('''SELECT dialogs::text[] FROM users
-                     WHERE name = %s OR name = %s''', (nick, user))
-        dlg1 = set(c.fetchone()['dialogs'])
-        dlg2 = set(c.fetchone()['dialogs'])
-
-        common_dialog = dlg1.intersection(dlg2)
+        c = self.db.cursor()
+        c.execute('''SELECT own.target FROM relations own
+                     JOIN relations other ON other.target = own.target AND
+                     other.kind = 'dialogs' AND other.owner = %s
+                     WHERE own.owner = %s AND own.kind = 'dialogs' ''',
+                  (user, nick))
+        common_dialog = c.fetchone()
 
         if common_dialog:
             # Если у отправителя и пользователя user есть общий диалог
             return self._pack(sc.create_dialog_succ, request_id,
-                              int(common_dialog.pop()))
+                              int(common_dialog['target']))
 
         d_st = str(self._next_free_dialog())
         with self.db:
-            c.execute('''CREATE TABLE d{} (content text,
-                                           timestamp bigint,
-                                           sender text)'''.format(d_st))
+            c.execute('''INSERT INTO dialogs VALUES (%s)''', (int(d_st),))
 
         self._add_to(nick, d_st, 'dialogs')
         self._add_to(user, d_st, 'dialogs')
@@ -724,11 +951,11 @@ class Processor:
         c.close()
         return self._pack(sc.create_dialog_succ, request_id, int(d_st))
 
-    def profile_info(self, request_id, ip, user):
+    def profile_info(self, request_id, session, user):
         """Получить информацию о пользователе user
         Вызывает BadRequest, если отправитель находится
         в черном списке пользователя user"""
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         self._user_exists(user)
         if self._is_blacklisted(nick, user):
             raise BadRequest
@@ -743,29 +970,30 @@ class Processor:
         return self._pack(sc.profile_info, request_id, *info,
                           b64encode(bytes(img_data)).decode())
 
-    def remove_from_blacklist(self, request_id, ip, user, conns):
+    def remove_from_blacklist(self, request_id, session, user, conns):
         """Удалить пользователя user из черного списка отправителя"""
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         self._user_exists(user)
         self._remove_from(nick, user, 'blacklist')
 
-        self._send_notification(user, sc.friends_group_update, conns)
+        # Группы пользователя user не меняются, поэтому уведомление
+        # ему не отправляется
         return self._pack(sc.remove_from_blacklist_succ, request_id)
 
-    def take_request_back(self, request_id, ip, user, conns):
+    def take_request_back(self, request_id, session, user, conns):
         """Отменить запрос от отправителя к пользователю user"""
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         self._user_exists(user)
         self._remove_add_request(nick, user)
 
-        self._send_notification(user, sc.friends_group_update, conns)
+        self._send_update([user], conns, removed = [['incoming', nick]])
         return self._pack(sc.take_request_back_succ, request_id)
 
-    def confirm_add_request(self, request_id, ip, user, conns):
+    def confirm_add_request(self, request_id, session, user, conns):
         """Принять запрос на добавление от пользователя user отправителем
         Вызывает BadRequest, если пользователь user
         находится в черном списке отправителя"""
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         self._user_exists(user)
         if self._is_blacklisted(user, nick):
             raise BadRequest
@@ -773,83 +1001,79 @@ class Processor:
         self._add_to(user, nick, 'friends')
         self._add_to(nick, user, 'friends')
 
-        self._send_notification(user, sc.friends_group_update, conns)
+        self._send_update([user], conns, added = [['friends', nick, True]],
+                          removed = [['outgoing', nick]])
         return self._pack(sc.confirm_add_request_succ, request_id)
 
-    def add_to_favorites(self, request_id, ip, user):
+    def add_to_favorites(self, request_id, session, user):
         """Добавить пользователя user в избранное отправителя
         Вызывает BadRequest, если пользователь user
         не находится в друзьях отправителя"""
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         self._user_exists(user)
 
-        c = self.db.cursor()
-        c.execute('''SELECT name FROM users
-                     WHERE name = %s AND %s = ANY(friends::text[])''',
-                  (nick, user))
-        if not c.fetchone():
+        if not self._in_section(nick, user, 'friends'):
             raise BadRequest
         self._add_to(nick, user, 'favorites')
 
-        c.close()
         return self._pack(sc.add_to_favorites_succ, request_id)
 
-    def search_msg(self, request_id, ip, dialog, text, lower_tm, upper_tm):
+    def search_msg(self, request_id, session, dialog, text,
+                   lower_tm, upper_tm):
         """Найти в диалоге под номером dialog сообщение,
         содержащее строку text и отправленное между
         временами lower_tm и upper_tm
         Вызывает BadRequest, если lower_tm > upper_tm"""
         if lower_tm > upper_tm:
             raise BadRequest
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         self._user_in_dialog(nick, dialog)
 
         c = self.db.cursor()
-        c.execute('''SELECT * FROM d{}
-                     WHERE POSITION(%s IN content) > 0 AND
-                     timestamp BETWEEN %s AND %s'''.format(dialog),
-                  (text, lower_tm, upper_tm))
+        c.execute('''SELECT id, content, timestamp, sender FROM messages
+                     WHERE dialog = %s AND POSITION(%s IN content) > 0 AND
+                     timestamp BETWEEN %s AND %s
+                     ORDER BY timestamp, id''',
+                  (dialog, text, lower_tm, upper_tm))
         result = map(tuple, c.fetchall())
 
         c.close()
         return self._pack(sc.search_msg_result, request_id, list(result))
 
-    def remove_from_favorites(self, request_id, ip, user):
+    def remove_from_favorites(self, request_id, session, user):
         """Удалить пользователя user из избранного отправителя"""
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         self._user_exists(user)
         self._remove_from(nick, user, 'favorites')
         return self._pack(sc.remove_from_favorites_succ, request_id)
 
-    def add_requests(self, request_id, ip):
+    def add_requests(self, request_id, session):
         """Получить запросы на добавление к отправителю и от него"""
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
+        online = self.presence.is_online
         c = self.db.cursor()
-        c.execute('''SELECT name FROM sessions''')
-        online = {i['name'] for i in c.fetchall()}
-
         c.execute('''SELECT from_who, message FROM requests
                      WHERE to_who = %s''', (nick,))
-        inc = [(*i, i[0] in online) for i in map(tuple, c.fetchall())]
+        inc = [(*i, online(i[0])) for i in map(tuple, c.fetchall())]
         c.execute('''SELECT to_who, message FROM requests
                      WHERE from_who = %s''', (nick,))
-        outc = [(*i, i[0] in online) for i in map(tuple, c.fetchall())]
+        outc = [(*i, online(i[0])) for i in map(tuple, c.fetchall())]
         c.close()
         return self._pack(sc.add_requests, request_id, [inc, outc])
 
-    def decline_add_request(self, request_id, ip, user, conns):
+    def decline_add_request(self, request_id, session, user, conns):
         """Отменить запрос на добавление от пользователя user к отправителю"""
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         self._user_exists(user)
         self._remove_add_request(user, nick)
 
-        self._send_notification(user, sc.friends_group_update, conns)
+        self._send_update([user], conns, removed = [['outgoing', nick]])
         return self._pack(sc.decline_add_request_succ, request_id)
 
-    def set_image(self, request_id, ip, img_data):
+    def set_image(self, request_id, session, img_data):
         """Установить в качестве изображения пользователя картинку,
         бинарные данные в base64 которой находятся в img_data"""
-        nick = self._get_nick(ip)
+        nick = self._session_nick(session)
         c = self.db.cursor()
         with self.db:
             c.execute('''UPDATE profiles SET image = %s
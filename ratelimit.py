@@ -0,0 +1,37 @@
+import time
+
+
+class RateLimiter:
+    """Ограничивает частоту запросов с каждого IP-адреса
+    алгоритмом token bucket: запас запроса пополняется со скоростью
+    rate в секунду и не превышает burst"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        # Запас и время его последнего пересчета по IP-адресам
+        self.buckets = {}
+        self.last_prune = time.monotonic()
+
+    def allow(self, ip):
+        """Расходует один запрос с IP-адреса ip
+        Возвращает False, если запас исчерпан"""
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        tokens, last = self.buckets.get(ip, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if now - self.last_prune > self.burst / self.rate:
+            self.prune(now)
+
+        if tokens < 1:
+            self.buckets[ip] = (tokens, now)
+            return False
+        self.buckets[ip] = (tokens - 1, now)
+        return True
+
+    def prune(self, now):
+        """Удаляет записи адресов, запас которых уже восполнился"""
+        full = self.burst / self.rate
+        self.buckets = {ip: v for ip, v in self.buckets.items()
+                        if now - v[1] < full}
+        self.last_prune = now
@@ -1,15 +1,57 @@
-import json, logging, os
+import binascii, json, logging, os, time
 from base64 import b64decode
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
+# crypto_pool импортируется до processors, который подключается к базе
+import crypto, crypto_pool
+from ratelimit import RateLimiter
+from session import Session
 from processors import Processor, cc, sc, BadRequest
 
-from tornado.ioloop import IOLoop
+from tornado import gen, locks
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.web import Application, RequestHandler as HTTPRequestHandler
 from tornado.websocket import WebSocketHandler
 
 
 class RequestHandler:
     pr = Processor()
+    # Запросы к базе данных блокируют поток, поэтому обработка
+    # выполняется в пулах потоков, по соединению из пула на поток
+    # Запросы делятся на классы по стоимости, и у каждого класса свой
+    # пул, чтобы поиск и изображения не задерживали переписку:
+    # fast - сообщения и служебные запросы к таблице сессий,
+    # heavy - поиск, изображения и удаление профиля, normal - остальные
+    fast_codes = {cc.send_message,
+                  cc.get_message_history,
+                  cc.sync,
+                  cc.create_dialog,
+                  cc.friends_group}
+    heavy_codes = {cc.get_search_list,
+                   cc.search_msg,
+                   cc.set_image,
+                   cc.get_profile_info,
+                   cc.delete_profile}
+    # Потоки делятся между классами так, чтобы всего их было
+    # не больше, чем соединений в пуле (DB_POOL_SIZE)
+    fast_workers = (int(os.getenv('FAST_WORKERS', 0)) or
+                    max(1, Processor.pool_size // 2))
+    heavy_workers = (int(os.getenv('HEAVY_WORKERS', 0)) or
+                     max(1, Processor.pool_size // 4))
+    normal_workers = Processor.pool_size - fast_workers - heavy_workers
+    if normal_workers >= 1:
+        lanes = {'fast': ThreadPoolExecutor(fast_workers),
+                 'normal': ThreadPoolExecutor(normal_workers),
+                 'heavy': ThreadPoolExecutor(heavy_workers)}
+    else:
+        # Соединений не хватает на отдельный пул каждому классу,
+        # поэтому все запросы выполняются в одном общем пуле
+        # (если FAST_WORKERS или HEAVY_WORKERS заданы, start отклоняет
+        # такие настройки)
+        lanes = dict.fromkeys(('fast', 'normal', 'heavy'),
+                              ThreadPoolExecutor(Processor.pool_size))
+    crypto_executor = crypto_pool.executor
     handler_map = {
         cc.register:                  pr.register,
         cc.login:                     pr.login,
@@ -34,6 +76,7 @@ class RequestHandler:
         cc.get_add_requests:          pr.add_requests,
         cc.decline_add_request:       pr.decline_add_request,
         cc.set_image:                 pr.set_image,
+        cc.sync:                      pr.sync,
     }
     set_image_code = str(cc.set_image).encode()
     profile_info_code = str(sc.profile_info).encode()
@@ -52,20 +95,68 @@ class RequestHandler:
                cc.decline_add_request}
 
     connections = {}
-
-    def process(self, enc_request, address, signature, enc_key):
-        """Главный цикл работы сервера,
-        отвечающий за обработку запросов"""
-        log.info('received request from {}'.format(address))
+    # Как часто в секундах накопленные даты активности сессий
+    # записываются в таблицу sessions
+    activity_interval = float(os.getenv('ACTIVITY_FLUSH', 5))
+    # Раз в KEEPALIVE_INTERVAL секунд клиентам отправляется ping,
+    # соединения, от которых ничего не приходило дольше
+    # KEEPALIVE_TIMEOUT секунд, закрываются, а сессии, неактивные
+    # дольше SESSION_TIMEOUT секунд, удаляются
+    keepalive_interval = float(os.getenv('KEEPALIVE_INTERVAL', 20))
+    keepalive_timeout = float(os.getenv('KEEPALIVE_TIMEOUT', 60))
+    session_timeout = int(os.getenv('SESSION_TIMEOUT', 120))
+
+    def submit(self, func, *args, lane = 'fast'):
+        """Запускает func с аргументами args в пуле потоков класса lane
+        Возвращает Future с результатом"""
+        return self.lanes[lane].submit(self._run, func, *args)
+
+    def lane(self, code):
+        """Возвращает класс стоимости запроса с кодом code"""
+        if code in self.fast_codes:
+            return 'fast'
+        if code in self.heavy_codes:
+            return 'heavy'
+        return 'normal'
+
+    def _run(self, func, *args):
+        try:
+            return func(*args)
+        finally:
+            self.pr._end_transaction()
+
+    def submit_crypto(self, func, *args):
+        """Запускает функцию func модуля crypto в пуле процессов
+        Возвращает Future с результатом"""
+        return self.crypto_executor.submit(func, *args)
+
+    @gen.coroutine
+    def _decrypt_request(self, enc_request, session, enc_key):
+        """Расшифровывает запрос enc_request ключом enc_key: ключом AES,
+        зашифрованным RSA, или nonce сессионного ключа сессии session
+        Возвращает расшифрованный запрос, его код и данные
+        Вызывает crypto.CryptoError, если запрос не удалось расшифровать
+        или распаковать"""
+        # Вместо ключа, зашифрованного RSA, клиент, получивший
+        # сессионный ключ, передает nonce
+        if crypto.is_nonce(enc_key):
+            if not session.has_keys:
+                # Если для сессии не выдавался сессионный ключ, игнорируем
+                log.error('failed to get session key')
+                raise crypto.CryptoError
+            func, key = crypto.session_decrypt, session.sym_key
+        else:
+            func, key = crypto.decrypt, self.pr.priv_key
 
         try:
-            request = self.pr._decrypt(enc_request, enc_key)
+            request = yield self.submit_crypto(func, enc_request, enc_key,
+                                               key)
             log.info('decrypted request successfully')
-        except BadRequest:
+        except crypto.CryptoError:
             # Если расшифровать запрос не удалось, игнорируем
             log.error('failed to decrypt request')
-            log.debug('request: {}'.format(request))
-            return b''
+            log.debug('request: {}'.format(enc_request))
+            raise
 
         try:
             code, *data = json.loads('[' + request.decode() + ']')
@@ -73,32 +164,93 @@ class RequestHandler:
             # Если распаковать запрос не удалось, игнорируем
             log.error('failed to decode request')
             log.debug('request: {}'.format(request))
-            return b''
-
-        is_o_request = code in self.o_codes
-        if not is_o_request:
-            if not signature:
-                # Если подпись не указана, игнорируем
-                log.error('no signature for an N/T-request')
-                return b''
-
-            try:
-                pub_key = self.pr._get_public_key(address)
-            except BadRequest:
-                # Если нет сессии, открытой с IP-адреса address, игнорируем
-                log.error('failed to get public key')
-                return b''
+            raise crypto.CryptoError
+        return request, code, data
+
+    @gen.coroutine
+    def _authenticate(self, enc_request, session, signature, enc_key):
+        """Проверяет подпись RSA или код аутентификации signature
+        запроса enc_request, пришедшего в сессии session
+        Возвращает публичный ключ клиента, если он нужен для проверки
+        подписи или шифрования ответа, иначе None
+        Вызывает crypto.CryptoError, если проверка не пройдена"""
+        if not signature:
+            # Если подпись не указана, игнорируем
+            log.error('no signature for an N/T-request')
+            raise crypto.CryptoError
 
+        try:
+            signature = b64decode(signature)
+        except binascii.Error:
+            log.error('incorrect signature')
+            raise crypto.CryptoError
+
+        is_mac_request = crypto.is_mac(signature)
+        if is_mac_request:
+            self._verify_mac(enc_request, session, signature, enc_key)
+            if crypto.is_nonce(enc_key):
+                # Ответ будет зашифрован сессионным ключом,
+                # публичный ключ не нужен
+                return None
+
+        # Публичный ключ нужен для проверки подписи RSA или
+        # для шифрования ответа, если запрос зашифрован не сессионным
+        # ключом; получаем его до обработки, которая может закрыть сессию
+        if not session.logged_in:
+            # Если на соединении не открыта сессия, игнорируем
+            log.error('failed to get public key')
+            raise crypto.CryptoError
+
+        if not is_mac_request:
             try:
-                self.pr._verify_signature(enc_request, b64decode(signature),
-                                          pub_key)
-            except BadRequest:
+                yield self.submit_crypto(crypto.verify, enc_request,
+                                         signature, session.pub_key)
+            except crypto.CryptoError:
                 # Если подпись неверная, игнорируем
                 log.error('incorrect signature')
-                return b''
+                raise
+        return session.pub_key
+
+    def _verify_mac(self, enc_request, session, signature, enc_key):
+        """Проверяет код аутентификации signature запроса enc_request
+        сессионным ключом сессии session без обращения к базе данных
+        и операций RSA
+        Вызывает crypto.CryptoError, если проверка не пройдена"""
+        try:
+            if not session.has_keys:
+                raise crypto.CryptoError
+            crypto.verify_mac(enc_request, enc_key.encode(),
+                              signature, session.mac_key)
+        except crypto.CryptoError:
+            log.error('incorrect MAC')
+            raise
+
+    @gen.coroutine
+    def process(self, enc_request, session, signature, enc_key):
+        """Главный цикл работы сервера,
+        отвечающий за обработку запросов
+        session - сессия соединения, по которому пришел запрос"""
+        address = session.ip
+        log.info('received request from {}'.format(address))
+
+        # Сессионный ключ запоминается до обработки,
+        # которая может закрыть сессию
+        is_session_request = crypto.is_nonce(enc_key)
+        sym_key = session.sym_key
 
-        # Вставляем в запрос IP-адрес после ID запроса
-        data.insert(1, address)
+        pub_key = None
+        try:
+            request, code, data = yield self._decrypt_request(
+                enc_request, session, enc_key)
+            is_o_request = code in self.o_codes
+            if not is_o_request:
+                pub_key = yield self._authenticate(enc_request, session,
+                                                   signature, enc_key)
+        except crypto.CryptoError:
+            return b''
+
+        # Вставляем в запрос сессию после ID запроса
+        data.insert(1, session)
 
         try:
             # Выбор обработчика запроса, соответствующего его коду
@@ -109,7 +261,8 @@ class RequestHandler:
                 data.append(self.connections)
 
             # Запускаем обработчик и получаем ответ
-            response = handler(*data)
+            response = yield self.submit(handler, *data,
+                                         lane = self.lane(code))
         except (TypeError, IndexError, BadRequest):
             # Если в запросе логическая ошибка, игнорируем
             log.error('bad request from {}: {}'.format(address, request))
@@ -119,7 +272,7 @@ class RequestHandler:
         if isinstance(response, tuple):
             response, pub_key = response
         elif is_o_request:
-            pub_key = self.pr._get_public_key(address)
+            pub_key = session.pub_key
 
         # Следующий блок кода может быть небезопасен
         r_code, *r_data = json.loads('[' + response.decode() + ']')
@@ -127,14 +280,22 @@ class RequestHandler:
         log.info('response data: ' + str(r_data))
         log.debug('response: {}'.format(response))
 
+        # Ответ на вход или регистрацию содержит новый сессионный ключ,
+        # поэтому всегда шифруется публичным ключом клиента
         try:
-            enc_response = self.pr._encrypt(response, pub_key)
+            if is_session_request and not is_o_request:
+                enc_response = yield self.submit_crypto(
+                    crypto.session_encrypt, response, sym_key)
+            else:
+                enc_response = yield self.submit_crypto(crypto.encrypt,
+                                                        response, pub_key)
         except OverflowError:
             log.error('server response was too large to encrypt')
             log.debug('response: {}'.format(response))
+            return b''
         log.info('encrypted response successfully')
 
-        # Записываем текущую дату
+        # Запоминаем текущую дату, в базу она записывается позже
         self.pr._set_timestamp(address)
         log.info('set new timestamp for ' + address)
 
@@ -144,13 +305,114 @@ class RequestHandler:
     def get_key(self):
         return self.pr.pub_key_str
 
+    def start(self):
+        """Запускает прием событий других процессов сервера,
+        периодическую запись дат активности сессий
+        и проверку соединений
+        Вызывает ValueError, если SESSION_TIMEOUT не больше суммы
+        KEEPALIVE_INTERVAL и ACTIVITY_FLUSH или если заданные потоки
+        классов запросов не оставляют потоков классу normal"""
+        # Иначе ответы на ping не успевали бы продлить сессии,
+        # и неактивные, но подключенные клиенты теряли бы их
+        min_timeout = self.keepalive_interval + self.activity_interval
+        if self.session_timeout <= min_timeout:
+            raise ValueError('SESSION_TIMEOUT must be greater than '
+                             'KEEPALIVE_INTERVAL + ACTIVITY_FLUSH '
+                             '({} seconds)'.format(min_timeout))
+        # Общий пул подходит только для числа потоков по умолчанию,
+        # заданное явно не должно молча игнорироваться
+        lanes_set = os.getenv('FAST_WORKERS') or os.getenv('HEAVY_WORKERS')
+        if lanes_set and self.normal_workers < 1:
+            raise ValueError('FAST_WORKERS + HEAVY_WORKERS must be less '
+                             'than DB_POOL_SIZE ({})'.format(
+                                 self.pr.pool_size))
+        self.pr._start_bus(self.connections)
+        PeriodicCallback(self.flush_activity,
+                         self.activity_interval * 1000).start()
+        PeriodicCallback(self.keepalive,
+                         self.keepalive_interval * 1000).start()
+
+    @gen.coroutine
+    def flush_activity(self):
+        updated = yield self.submit(self.pr._flush_timestamps,
+                                    lane = 'normal')
+        if updated:
+            log.debug('updated last_active of {} sessions'.format(updated))
+
+    @gen.coroutine
+    def keepalive(self):
+        """Закрывает соединения, которые перестали отвечать, проверяет
+        остальные через ping и удаляет неактивные сессии"""
+        now = time.monotonic()
+        for conn in list(self.connections.values()):
+            if now - conn.last_seen > self.keepalive_timeout:
+                conn.evict()
+            elif conn.ws_connection is not None:
+                conn.ping(b'')
+
+        # Даты активности записываются до удаления, чтобы не удалить
+        # сессии, активные с прошлой записи
+        yield self.flush_activity()
+        before = int(time.time()) - self.session_timeout
+        reaped = yield self.submit(self.pr._reap_sessions, before,
+                                   self.connections, lane = 'normal')
+        for ip in reaped:
+            conn = self.connections.get(ip)
+            if conn is not None:
+                conn.evict()
+        if reaped:
+            log.info('removed {} inactive sessions'.format(len(reaped)))
+
 
 class Connector(WebSocketHandler):
+    # Окно в миллисекундах, за которое уведомления клиенту собираются
+    # в один кадр (0 - до следующей итерации цикла событий)
+    notify_window = float(os.getenv('NOTIFY_WINDOW', 0)) / 1000
+    # Ограничения очереди отправки соединения: объем данных, записанных
+    # в сокет, но еще не переданных клиенту, и ожидающих записи,
+    # и число уведомлений, ожидающих отправки
+    max_queue_bytes = int(os.getenv('SEND_QUEUE_BYTES', 256 * 1024))
+    max_queue_messages = int(os.getenv('SEND_QUEUE_MESSAGES', 256))
+    # Через сколько секунд очередь клиента, который не успевает
+    # принимать данные, проверяется снова
+    drain_interval = 0.05
+    # Что делать с уведомлениями, если клиент не успевает их принимать:
+    # drop - отбрасывать новые, coalesce - заменять ожидающие
+    # уведомления их кодами без данных, disconnect - закрывать соединение
+    slow_consumer = os.getenv('SLOW_CONSUMER', 'coalesce')
+    # Счетчики очередей отправки и отклоненных запросов всех соединений
+    stats = Counter()
+    # Максимальный размер запроса в байтах и допустимая частота
+    # запросов с одного IP-адреса: в среднем RATE_LIMIT в секунду
+    # (0 - без ограничения) и не более RATE_BURST подряд
+    max_frame_size = int(os.getenv('MAX_FRAME_SIZE', 4 * 1024 * 1024))
+    limiter = RateLimiter(float(os.getenv('RATE_LIMIT', 20)),
+                          int(os.getenv('RATE_BURST', 40)))
+
     def initialize(self, handler):
         self.handler = handler
 
     def open(self):
         self._address = self.request.headers['X-Forwarded-For']
+        self.session = Session(self._address)
+        # Когда от клиента последний раз что-то приходило
+        self.last_seen = time.monotonic()
+        self._loop = IOLoop.current()
+        # Уведомления, ожидающие отправки
+        self._pending = []
+        self._pending_set = set()
+        self._pending_bytes = 0
+        self._flush_scheduled = False
+        # Ответы, ожидающие записи в сокет
+        self._responses = deque()
+        self._responses_bytes = 0
+        # Ждет ли очередь, пока клиент примет уже записанные данные
+        self._congested = False
+        self._drain_scheduled = False
+        # Запросы соединения обрабатываются по одному, чтобы ответы
+        # приходили в порядке запросов, а запрос, отправленный сразу
+        # после входа, выполнялся уже в открытой сессии
+        self._request_lock = locks.Lock()
 
         if self._address in self.handler.connections:
             self.write_message('Connection refused')
@@ -158,16 +420,215 @@ class Connector(WebSocketHandler):
 
         self.handler.connections[self._address] = self
 
+    @gen.coroutine
     def on_message(self, message):
-        enc_request, sign, enc_key = message.split(':')
-        resp = self.handler.process(enc_request.encode(), self._address,
-                                    sign, enc_key)
-        self.write_message(resp, binary = True)
+        self.last_seen = time.monotonic()
+        # Лишние запросы отклоняются до расшифровки,
+        # которая обходится намного дороже
+        rejected = True
+        if len(message) > self.max_frame_size:
+            log.error('request from {} is too large'.format(self._address))
+            self.stats['oversized'] += 1
+            message = None
+        elif not self.limiter.allow(self._address):
+            log.error('too many requests from ' + self._address)
+            self.stats['rate_limited'] += 1
+        else:
+            rejected = False
+
+        with (yield self._request_lock.acquire()):
+            if self.ws_connection is None:
+                return
+            if rejected:
+                self.send(b'')
+                return
+            try:
+                enc_request, sign, enc_key = message.split(':')
+                resp = yield self.handler.process(enc_request.encode(),
+                                                  self.session, sign,
+                                                  enc_key)
+            except Exception:
+                # Необработанная ошибка, например в разборе
+                # неправильного кадра, закрывает соединение
+                log.exception('failed to process request from ' +
+                              self._address)
+                self.close()
+                return
+            self.send(resp)
+
+    def on_pong(self, data):
+        self.last_seen = time.monotonic()
+        if self.session.logged_in:
+            # Клиент в сети, даже если не отправляет запросов
+            self.handler.pr._set_timestamp(self._address)
+
+    def evict(self):
+        """Закрывает соединение клиента, который перестал отвечать"""
+        log.info('closing inactive connection from ' + self._address)
+        self.stats['evicted'] += 1
+        if self.handler.connections.get(self._address) is self:
+            del self.handler.connections[self._address]
+        self._clear_queue()
+        self.close()
+
+    def write_message(self, message, binary = False):
+        if IOLoop.current(instance = False) is self._loop:
+            return super().write_message(message, binary = binary)
+        # Уведомления отправляются из потоков пула, а писать в сокет
+        # можно только из потока цикла событий
+        self._loop.add_callback(self.write_message, message, binary)
+
+    def send(self, response):
+        """Ставит ответ response в очередь на отправку
+        Если клиент не принимает ответы и ожидающих записи данных
+        уже больше max_queue_bytes, соединение закрывается"""
+        if self.ws_connection is None:
+            return
+        # Записанное в сокет не учитывается, а один ответ принимается
+        # при любом размере: ограничение касается клиентов, которые
+        # не читают ответы, а не больших ответов
+        backlog = self._responses_bytes + self._pending_bytes
+        if self._responses and backlog > self.max_queue_bytes:
+            # Ответы нельзя отбросить, не нарушив протокол
+            self._disconnect()
+            return
+        self._responses.append(response)
+        self._responses_bytes += len(response)
+        self._update_peak()
+        self._pump()
+
+    def notify(self, message):
+        """Ставит уведомление message в очередь на отправку
+        Одинаковые уведомления, ожидающие отправки, не дублируются,
+        а все ожидающие уведомления отправляются одним кадром,
+        по одному на строку
+        Можно вызывать из любого потока"""
+        self._loop.add_callback(self._enqueue, message)
+
+    def _enqueue(self, message):
+        if self.ws_connection is None or message in self._pending_set:
+            return
+        queued = self._queued_bytes()
+        if len(self._pending) >= self.max_queue_messages or \
+           queued and queued + len(message) > self.max_queue_bytes:
+            message = self._overflow(message)
+            if message is None or message in self._pending_set:
+                return
+        self._pending.append(message)
+        self._pending_set.add(message)
+        self._pending_bytes += len(message)
+        self.stats['queued'] += 1
+        self._update_peak()
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            if self.notify_window:
+                self._loop.call_later(self.notify_window, self._flush)
+            else:
+                self._loop.add_callback(self._flush)
+
+    def _overflow(self, message):
+        """Применяет политику slow_consumer к переполненной очереди
+        Возвращает уведомление, которое нужно поставить в очередь,
+        или None"""
+        if self.slow_consumer == 'disconnect':
+            self._disconnect()
+            return None
+        if self.slow_consumer == 'coalesce':
+            # Клиент, получивший код уведомления без данных,
+            # запрашивает актуальное состояние сам
+            codes = [i.split(b',', 1)[0] for i in self._pending]
+            codes.append(message.split(b',', 1)[0])
+            codes = list(OrderedDict.fromkeys(codes))
+            self.stats['coalesced'] += len(self._pending) + 1 - len(codes)
+            self._pending = codes[:-1]
+            self._pending_set = set(self._pending)
+            self._pending_bytes = sum(map(len, self._pending))
+            if self._queued_bytes() + len(codes[-1]) <= self.max_queue_bytes:
+                return codes[-1]
+        self.stats['dropped'] += 1
+        return None
+
+    def _flush(self):
+        self._flush_scheduled = False
+        self._pump()
+
+    def _pump(self):
+        """Записывает в сокет ответы и уведомления из очереди,
+        пока объем непереданных клиенту данных не превысит
+        max_queue_bytes"""
+        while self.ws_connection is not None:
+            if self._unsent_bytes() >= self.max_queue_bytes:
+                self._wait_drain()
+                return
+            if self._responses:
+                frame = self._responses.popleft()
+                self._responses_bytes -= len(frame)
+            elif self._pending and not self._flush_scheduled:
+                frame = b'\n'.join(self._pending)
+                self._pending = []
+                self._pending_set = set()
+                self._pending_bytes = 0
+            else:
+                self._congested = False
+                return
+            self.stats['sent_frames'] += 1
+            self.stats['sent_bytes'] += len(frame)
+            super().write_message(frame, binary = True)
+
+    def _wait_drain(self):
+        """Откладывает запись очереди, пока клиент не примет данные,
+        уже записанные в сокет
+        Future записи для этого не подходит: Tornado не завершает его,
+        если после него в поток пишет кто-то еще (ping, pong, закрытие)"""
+        if not (self._responses or self._pending):
+            return
+        if not self._congested:
+            # Клиент не успевает принимать данные
+            self._congested = True
+            self.stats['congested'] += 1
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            self._loop.call_later(self.drain_interval, self._drain)
+
+    def _drain(self):
+        self._drain_scheduled = False
+        self._pump()
+
+    def _unsent_bytes(self):
+        """Объем данных, записанных в сокет, но еще не переданных
+        клиенту, по буферу записи потока"""
+        if self.stream is None or self.stream.closed():
+            return 0
+        return self.stream._write_buffer_size
+
+    def _queued_bytes(self):
+        waiting = self._responses_bytes + self._pending_bytes
+        return self._unsent_bytes() + waiting
+
+    def _update_peak(self):
+        if self._queued_bytes() > self.stats['peak_queue_bytes']:
+            self.stats['peak_queue_bytes'] = self._queued_bytes()
+
+    def _disconnect(self):
+        log.warning('closing slow connection from ' + self._address)
+        self.stats['disconnected'] += 1
+        self._clear_queue()
+        self.close()
+
+    def _clear_queue(self):
+        self._pending = []
+        self._pending_set = set()
+        self._pending_bytes = 0
+        self._responses.clear()
+        self._responses_bytes = 0
 
     def on_close(self):
-        self.handler.pr._clean_up(self._address)
-        if self._address in self.handler.connections:
-            self.handler.connections.pop(self._address)
+        self._clear_queue()
+        self.session.close()
+        self.handler.submit(self.handler.pr._clean_up, self._address,
+                            self.handler.connections)
+        if self.handler.connections.get(self._address) is self:
+            del self.handler.connections[self._address]
 
 
 class KeyHandler(HTTPRequestHandler):
@@ -178,6 +639,20 @@ class KeyHandler(HTTPRequestHandler):
         self.write(self.handler.get_key())
 
 
+class StatsHandler(HTTPRequestHandler):
+    """Показывает счетчики соединений и текущий объем очередей отправки
+    Доступен только с локального адреса на порту STATS_PORT"""
+    def initialize(self, handler):
+        self.handler = handler
+
+    def get(self):
+        conns = list(self.handler.connections.values())
+        stats = dict(Connector.stats)
+        stats['connections'] = len(conns)
+        stats['queue_bytes'] = sum(i._queued_bytes() for i in conns)
+        self.write(stats)
+
+
 if __name__ == "__main__":
     log_level = logging.DEBUG
 
@@ -194,6 +669,7 @@ if __name__ == "__main__":
     log.addHandler(log_handler)
 
     log.info('starting up')
+    handler = None
     try:
         handler = RequestHandler()
         app = Application([(r'/', Connector, dict(handler = handler)),
@@ -201,8 +677,19 @@ if __name__ == "__main__":
 
         app.listen(os.getenv('PORT', 8080))
 
+        # Статистика не отдается наружу: без STATS_PORT она выключена
+        stats_port = os.getenv('STATS_PORT')
+        if stats_port:
+            stats_app = Application([(r'/stats', StatsHandler,
+                                      dict(handler = handler))])
+            stats_app.listen(stats_port, address = '127.0.0.1')
+
+        handler.start()
         IOLoop.current().start()
     except KeyboardInterrupt:
+        # Прерывание могло прийти раньше, чем был создан обработчик
+        if handler is not None:
+            handler.pr._flush_timestamps()
         log.info('manual exit')
     except Exception as e:
         log.exception('exception occured')
@@ -0,0 +1,32 @@
+class Session:
+    """Сессия клиента, связанная с его соединением
+    Заполняется при входе или регистрации, чтобы при обработке
+    запросов не искать сессию в таблице sessions по IP-адресу"""
+    def __init__(self, ip):
+        self.ip = ip
+        self.close()
+
+    def open(self, nick, pub_key, sym_key = None, mac_key = None):
+        """Отмечает, что пользователь nick вошел в систему
+        с публичным ключом pub_key (rsa.PublicKey) и сессионными
+        ключами sym_key (шифрование) и mac_key (аутентификация)"""
+        self.nick = nick
+        self.pub_key = pub_key
+        self.sym_key = sym_key
+        self.mac_key = mac_key
+
+    def close(self):
+        """Отмечает, что пользователь вышел из системы"""
+        self.nick = None
+        self.pub_key = None
+        self.sym_key = None
+        self.mac_key = None
+
+    @property
+    def logged_in(self):
+        return self.nick is not None
+
+    @property
+    def has_keys(self):
+        """Выданы ли сессионные ключи"""
+        return self.sym_key is not None
@@ -0,0 +1,148 @@
+import os, threading
+import psycopg2
+
+
+class PostgresStore:
+    """Хранит сессии в таблице sessions
+    Таблица создается нежурналируемой (UNLOGGED): сессии не переживают
+    перезапуск сервера, поэтому их изменения не пишутся в WAL
+    Методы принимают соединение db потока, который их вызывает"""
+    name = 'postgres'
+
+    def add(self, db, nick, pub_key, ip, stamp, sym_key = None,
+            mac_key = None):
+        """Добавляет сессию пользователя nick с IP-адреса ip
+        Возвращает False, если сессия с этого IP-адреса уже есть"""
+        c = db.cursor()
+        try:
+            with db:
+                c.execute('''INSERT INTO sessions (name, pub_key, ip,
+                                                  last_active,
+                                                  sym_key, mac_key)
+                             VALUES (%s, %s, %s, %s, %s, %s)''',
+                          (nick, pub_key, ip, stamp, sym_key, mac_key))
+        except psycopg2.IntegrityError:
+            return False
+        finally:
+            c.close()
+        return True
+
+    def all(self, db):
+        """Возвращает пары (имя пользователя, IP-адрес) всех сессий"""
+        c = db.cursor()
+        c.execute('''SELECT name, ip FROM sessions''')
+        sessions = [(i['name'], i['ip']) for i in c.fetchall()]
+        c.close()
+        return sessions
+
+    def remove(self, db, ip):
+        """Удаляет сессию с IP-адреса ip"""
+        c = db.cursor()
+        with db:
+            c.execute('''DELETE FROM sessions
+                         WHERE ip = %s''', (ip,))
+        c.close()
+
+    def touch(self, db, activity, chunk):
+        """Записывает даты последней активности из списка пар
+        (IP-адрес, дата), обновляя по chunk сессий одним запросом
+        Возвращает число обновленных сессий"""
+        c = db.cursor()
+        updated = 0
+        with db:
+            for i in range(0, len(activity), chunk):
+                values = b','.join(c.mogrify('(%s, %s)', row)
+                                   for row in activity[i:i + chunk])
+                c.execute(b'''UPDATE sessions SET last_active = v.stamp
+                             FROM (VALUES ''' + values + b''')
+                                  AS v(ip, stamp)
+                             WHERE sessions.ip = v.ip''')
+                updated += c.rowcount
+        c.close()
+        return updated
+
+    def reap(self, db, before, chunk):
+        """Удаляет сессии, последняя активность которых была раньше
+        before, по chunk сессий одним запросом
+        Возвращает IP-адреса удаленных сессий"""
+        c = db.cursor()
+        reaped = []
+        while True:
+            c.execute('''DELETE FROM sessions
+                         WHERE ip IN (SELECT ip FROM sessions
+                                      WHERE last_active < %s
+                                      ORDER BY last_active
+                                      LIMIT %s)
+                         RETURNING ip''', (before, chunk))
+            ips = [i['ip'] for i in c.fetchall()]
+            db.commit()
+            reaped += ips
+            if len(ips) < chunk:
+                break
+        c.close()
+        return reaped
+
+
+class MemoryStore:
+    """Хранит сессии в памяти процесса
+    Подходит, если все соединения клиентов обслуживает один процесс:
+    сессии не пишутся в базу данных совсем"""
+    name = 'memory'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Имена пользователей сессий и даты их последней активности
+        # по IP-адресам
+        self.names = {}
+        self.last_active = {}
+
+    def add(self, db, nick, pub_key, ip, stamp, sym_key = None,
+            mac_key = None):
+        with self.lock:
+            if ip in self.names:
+                return False
+            self.names[ip] = nick
+            self.last_active[ip] = stamp
+        return True
+
+    def all(self, db):
+        with self.lock:
+            return [(nick, ip) for ip, nick in self.names.items()]
+
+    def remove(self, db, ip):
+        with self.lock:
+            self.names.pop(ip, None)
+            self.last_active.pop(ip, None)
+
+    def touch(self, db, activity, chunk):
+        updated = 0
+        with self.lock:
+            for ip, stamp in activity:
+                if ip in self.last_active:
+                    self.last_active[ip] = stamp
+                    updated += 1
+        return updated
+
+    def reap(self, db, before, chunk):
+        with self.lock:
+            reaped = [ip for ip, stamp in self.last_active.items()
+                      if stamp < before]
+            for ip in reaped:
+                del self.names[ip]
+                del self.last_active[ip]
+        return reaped
+
+
+STORES = (PostgresStore, MemoryStore)
+
+
+def get_store(name = None):
+    """Возвращает хранилище сессий с именем name ('postgres' или
+    'memory')
+    По умолчанию берется SESSION_STORE, а если он не задан - postgres
+    Вызывает ValueError, если хранилища с именем name нет"""
+    name = name or os.getenv('SESSION_STORE', 'postgres')
+    for cls in STORES:
+        if cls.name == name:
+            return cls()
+    raise ValueError('unknown session store: {}'.format(name))
@@ -0,0 +1,132 @@
+import unittest, os, rsa, pyaes
+from base64 import b64decode, b64encode
+from crypto import *
+
+
+class TestCrypto(unittest.TestCase):
+    pub_key, priv_key = rsa.newkeys(1024, accurate = False)
+    base = b'Hello, World'
+
+    def test_backends(self):
+        try:
+            native = NativeBackend()
+        except ImportError:
+            self.skipTest('cryptography is not installed')
+        pure = PureBackend()
+        key = new_session_key()
+        data = os.urandom(1000)
+
+        for counter in (RSA_COUNTER, 5 << 64, (1 << 128) - 2):
+            self.assertEqual(pure.aes_ctr(key, counter, data),
+                             native.aes_ctr(key, counter, data))
+
+        self.assertEqual(native.rsa_decrypt(pure.rsa_encrypt(key,
+                                                             self.pub_key),
+                                            self.priv_key), key)
+        self.assertEqual(pure.rsa_decrypt(native.rsa_encrypt(key,
+                                                             self.pub_key),
+                                          self.priv_key), key)
+
+        with self.assertRaises(CryptoError):
+            native.rsa_decrypt(b'not a key', self.priv_key)
+
+        with self.assertRaises(ValueError):
+            native.aes_ctr(b'short', RSA_COUNTER, data)
+
+    def test_numpy_backend(self):
+        try:
+            vectorized = NumpyBackend()
+        except ImportError:
+            self.skipTest('NumPy is not installed')
+        pure = PureBackend()
+
+        for size in (16, 24, 32):
+            key = os.urandom(size)
+            for length in (0, 1, 16, 1000):
+                data = os.urandom(length)
+                for counter in (RSA_COUNTER, (1 << 64) - 2, (1 << 128) - 2):
+                    self.assertEqual(pure.aes_ctr(key, counter, data),
+                                     vectorized.aes_ctr(key, counter, data))
+
+        vectorized.chunk_blocks = 3
+        data = os.urandom(100)
+        self.assertEqual(pure.aes_ctr(key, (1 << 64) - 2, data),
+                         vectorized.aes_ctr(key, (1 << 64) - 2, data))
+
+        with self.assertRaises(ValueError):
+            vectorized.aes_ctr(b'short', RSA_COUNTER, data)
+
+    def test_get_backend(self):
+        self.assertIsInstance(get_backend('pure'), PureBackend)
+        with self.assertRaises(ValueError):
+            get_backend('unknown')
+
+    def test_decrypt(self):
+        key = os.urandom(32)
+        aes = pyaes.AESModeOfOperationCTR(key)
+        encrypted = b64encode(aes.encrypt(self.base))
+        enc_key = b64encode(rsa.encrypt(key, self.pub_key))
+
+        self.assertEqual(decrypt(encrypted, enc_key, self.priv_key),
+                         self.base)
+
+        with self.assertRaises(CryptoError):
+            decrypt(b'not_encrypted', b'not a key', self.priv_key)
+
+    def test_encrypt(self):
+        enc_msg, enc_key = encrypt(self.base, self.pub_key).split(b':')
+        key = rsa.decrypt(b64decode(enc_key), self.priv_key)
+        aes = pyaes.AESModeOfOperationCTR(key)
+        self.assertEqual(aes.decrypt(b64decode(enc_msg)), self.base)
+
+    def test_verify(self):
+        sign = rsa.sign(self.base, self.priv_key, 'SHA-256')
+        verify(b64encode(self.base), sign, self.pub_key)
+
+        with self.assertRaises(CryptoError):
+            verify(b64encode(self.base), b'not_a_signature', self.pub_key)
+
+    def test_verify_mac(self):
+        key = new_session_key()
+        request, enc_key = b64encode(self.base), b64encode(b'nonce')
+        signature = mac(request, enc_key, key)
+        self.assertTrue(is_mac(signature))
+        self.assertFalse(is_mac(rsa.sign(self.base, self.priv_key,
+                                         'SHA-256')))
+
+        verify_mac(request, enc_key, signature, key)
+
+        with self.assertRaises(CryptoError):
+            verify_mac(request, b64encode(b'other'), signature, key)
+
+        with self.assertRaises(CryptoError):
+            verify_mac(request, enc_key, signature, new_session_key())
+
+    def test_is_nonce(self):
+        self.assertTrue(is_nonce(b64encode(os.urandom(NONCE_SIZE))))
+        self.assertFalse(is_nonce(b64encode(os.urandom(32))))
+        self.assertFalse(is_nonce(b'not base64'))
+
+    def test_session_encrypt(self):
+        key = new_session_key()
+        self.assertEqual(len(key), KEY_SIZE)
+
+        enc1, nonce1 = session_encrypt(self.base, key).split(b':')
+        enc2, nonce2 = session_encrypt(self.base, key).split(b':')
+        self.assertNotEqual(nonce1, nonce2)
+        self.assertNotEqual(enc1, enc2)
+
+        self.assertEqual(session_decrypt(enc1, nonce1, key), self.base)
+        self.assertEqual(session_decrypt(enc2, nonce2, key), self.base)
+
+        counter = pyaes.Counter(int.from_bytes(b64decode(nonce1),
+                                               'big') << 64)
+        aes = pyaes.AESModeOfOperationCTR(key, counter)
+        self.assertEqual(aes.decrypt(b64decode(enc1)), self.base)
+
+        with self.assertRaises(CryptoError):
+            session_decrypt(enc1, b64encode(b'short'), key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest, os
+from urllib.parse import urlparse
+import psycopg2, psycopg2.extras
+from migrator import Migrator
+from session_store import PostgresStore
+
+
+class TestMigrator(unittest.TestCase):
+    """Обновляет базу, созданную первой версией сервера"""
+    def setUp(self):
+        url = urlparse(os.environ['DATABASE_URL'])
+        self.db = psycopg2.connect(database = url.path[1:],
+                                   user = url.username,
+                                   password = url.password,
+                                   host = url.hostname,
+                                   port = url.port,
+                                   cursor_factory =
+                                   psycopg2.extras.DictCursor)
+        c = self.db.cursor()
+        c.execute('''DROP SCHEMA public CASCADE''')
+        c.execute('''CREATE SCHEMA public''')
+
+        c.execute('''CREATE TABLE users (name text PRIMARY KEY,
+                                         password text,
+                                         friends text ARRAY,
+                                         favorites text ARRAY,
+                                         blacklist text ARRAY,
+                                         dialogs text ARRAY)''')
+        c.execute('''CREATE TABLE profiles (name text PRIMARY KEY
+                                            REFERENCES users(name),
+                                            status text,
+                                            email text,
+                                            birthday bigint,
+                                            about text,
+                                            image bytea)''')
+        c.execute('''CREATE TABLE sessions (name text,
+                                            pub_key text ARRAY,
+                                            ip text UNIQUE,
+                                            last_active bigint)''')
+        c.execute('''CREATE TABLE requests (from_who text,
+                                            to_who text,
+                                            message text)''')
+        c.execute('''CREATE TABLE key (pub_key text ARRAY,
+                                       priv_key text ARRAY)''')
+        c.execute('''CREATE TABLE d0 (content text,
+                                      timestamp bigint,
+                                      sender text)''')
+
+        c.execute('''INSERT INTO users VALUES
+                     ('alice', 'pswd', '{"bob"}', '{}', '{}', '{"0"}'),
+                     ('bob', 'pswd', '{"alice"}', '{}', '{}', '{"0"}')''')
+        c.execute('''INSERT INTO d0 VALUES ('hi', 1, 'alice'),
+                                           ('hello', 2, 'bob')''')
+        c.execute('''INSERT INTO sessions VALUES
+                     ('alice', '{"1", "2"}', '1.1.1.1', 0)''')
+        self.db.commit()
+        c.close()
+
+    def tearDown(self):
+        c = self.db.cursor()
+        c.execute('''DROP SCHEMA public CASCADE''')
+        c.execute('''CREATE SCHEMA public''')
+        self.db.commit()
+        c.close()
+        self.db.close()
+
+    def test_migrate(self):
+        Migrator().migrate()
+        c = self.db.cursor()
+
+        c.execute('''SELECT owner, kind, target FROM relations
+                     ORDER BY owner, kind''')
+        relations = [tuple(i) for i in c.fetchall()]
+        self.assertListEqual(relations, [('alice', 'dialogs', '0'),
+                                         ('alice', 'friends', 'bob'),
+                                         ('bob', 'dialogs', '0'),
+                                         ('bob', 'friends', 'alice')])
+
+        c.execute('''SELECT dialog, content, sender FROM messages
+                     ORDER BY id''')
+        messages = [tuple(i) for i in c.fetchall()]
+        self.assertListEqual(messages, [(0, 'hi', 'alice'),
+                                        (0, 'hello', 'bob')])
+
+        c.execute('''SELECT relpersistence FROM pg_class
+                     WHERE relname = 'sessions' ''')
+        self.assertEqual(c.fetchone()[0], 'u')
+        c.close()
+
+        # Сессии с сессионными ключами открываются в обновленной базе
+        store = PostgresStore()
+        self.assertTrue(store.add(self.db, 'bob', ['3', '4'], '2.2.2.2', 0,
+                                  b'sym', b'mac'))
+        self.assertEqual(len(store.all(self.db)), 2)
+        self.db.commit()
+
+        # Повторный запуск ничего не меняет
+        Migrator().migrate()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,19 @@ from installer import Installer
 installer = Installer()
 installer.install()
 from processors import *
+from session import Session
+from session_store import MemoryStore
+
+
+class FakeBus:
+    name = 'fake'
+    shared = True
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, db, event):
+        self.published.append(event)
 
 
 class FakeConnection:
@@ -13,6 +26,9 @@ class FakeConnection:
             msg = msg.encode()
         self.buffer += msg
 
+    def notify(self, msg):
+        self.write_message(msg, binary = True)
+
     def __init__(self):
         self.buffer = b''
 
@@ -36,6 +52,28 @@ class TestProcessor(unittest.TestCase):
         code, *data = json.loads('[' + st + ']')
         return code, data
 
+    def add_user(self, c, name, pswd = '', friends = (), favorites = (),
+                 blacklist = (), dialogs = ()):
+        c.execute('''INSERT INTO users VALUES (%s, %s)''', (name, pswd))
+        for sect, items in (('friends', friends),
+                            ('favorites', favorites),
+                            ('blacklist', blacklist),
+                            ('dialogs', dialogs)):
+            c.executemany('''INSERT INTO relations (owner, kind, target)
+                             VALUES (%s, %s, %s)''',
+                          [(name, sect, i) for i in items])
+
+    def session(self, nick = None, ip = None):
+        session = Session(ip or self.ip)
+        session.open(nick or self.nick, self.pub_key)
+        return session
+
+    def get_relations(self, c, name, sect):
+        c.execute('''SELECT target FROM relations
+                     WHERE owner = %s AND kind = %s
+                     ORDER BY id''', (name, sect))
+        return [i['target'] for i in c.fetchall()]
+
     def test__request_id(self):
         r_id1 = self.pr._request_id()
         r_id2 = self.pr._request_id()
@@ -58,15 +96,76 @@ class TestProcessor(unittest.TestCase):
         send_ntf(self.nick, 0, conns)
         self.assertEqual(right.buffer, b'')
 
-    def test__get_public_key(self):
-        _get_public_key = self.pr._get_public_key
+    def test__send_notifications(self):
+        send_ntfs = self.pr._send_notifications
+        ips = ('ip1', 'ip2', 'ip3')
+        conns = {ip: FakeConnection() for ip in ips}
+        self.pr._add_session(self.nick, '1:2', 'ip1')
+        self.pr._add_session(self.nick, '3:4', 'ip2')
+        self.pr._add_session('user1', '5:6', 'ip3')
+
+        send_ntfs([self.nick, self.nick, 'user2'], 0, conns)
+        self.assertEqual(conns['ip1'].buffer, b'0')
+        self.assertEqual(conns['ip2'].buffer, b'0')
+        self.assertEqual(conns['ip3'].buffer, b'')
+
+        for ip in ips:
+            self.pr._close_session(ip)
+
+    def test__receive(self):
+        conns = {self.ip: FakeConnection()}
+        self.pr.bus = FakeBus()
+        published = self.pr.bus.published
+
+        self.pr._receive({'type': 'online', 'nick': self.nick,
+                          'ip': 'remote_ip'}, conns)
+        self.assertListEqual(self.pr.presence.ips(self.nick), ['remote_ip'])
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
 
-        self.assertEqual(_get_public_key(self.ip), self.pub_key)
-
+        self.pr._receive({'type': 'notify', 'users': [self.nick],
+                          'data': '0'}, conns)
+        self.assertEqual(conns[self.ip].buffer, b'0')
+        self.assertListEqual(published, [{'type': 'online',
+                                          'nick': self.nick,
+                                          'ip': self.ip}])
+
+        # Сессия в другом процессе получает уведомление через шину
+        del published[:]
+        self.pr._send_notification(self.nick, 1, conns)
+        self.assertEqual(conns[self.ip].buffer, b'01')
+        self.assertListEqual(published, [{'type': 'notify',
+                                          'users': [self.nick],
+                                          'data': '1'}])
+
+        self.pr._receive({'type': 'offline', 'ip': 'remote_ip'}, conns)
+        self.assertListEqual(self.pr.presence.ips(self.nick), [self.ip])
         self.pr._close_session(self.ip)
-        with self.assertRaises(BadRequest):
-            _get_public_key(self.ip)
+        del self.pr.bus
+
+    def test__sync_presence(self):
+        conns = {self.ip: FakeConnection()}
+        self.pr.bus = FakeBus()
+        self.pr.sessions.add(self.pr.db, 'user2', ['1', '2'], 'remote_ip',
+                             int(time.time()))
+        self.pr.db.commit()
+        self.pr.presence.add(self.nick, self.ip)
+        self.pr.presence.add('user3', 'stale_ip')
+
+        self.pr._sync_presence(conns)
+        self.assertListEqual(self.pr.presence.ips('user2'), ['remote_ip'])
+        self.assertListEqual(self.pr.presence.ips(self.nick), [self.ip])
+        self.assertFalse(self.pr.presence.is_online('user3'))
+
+        self.pr.presence.remove(self.ip)
+        self.pr._close_session('remote_ip')
+        del self.pr.bus
+
+    def test__start_bus(self):
+        self.pr.bus = FakeBus()
+        self.pr.sessions = MemoryStore()
+        with self.assertRaises(ValueError):
+            self.pr._start_bus({})
+        del self.pr.bus, self.pr.sessions
 
     def test__decrypt(self):
         _decrypt = self.pr._decrypt
@@ -128,6 +227,8 @@ class TestProcessor(unittest.TestCase):
                      WHERE name = %s AND pub_key = %s
                      AND ip = %s''', (self.nick, self.key_strings, self.ip))
         self.assertIsNotNone(c.fetchone())
+        self.assertTrue(self.pr.presence.is_online(self.nick))
+        self.assertListEqual(self.pr.presence.ips(self.nick), [self.ip])
 
         with self.assertRaises(BadRequest):
             _add_session(self.nick, ':'.join(self.key_strings), self.ip)
@@ -136,17 +237,113 @@ class TestProcessor(unittest.TestCase):
         self.pr.db.commit()
         c.close()
 
-    def test__get_nick(self):
-        _get_nick = self.pr._get_nick
+    def test__session_nick(self):
+        self.assertEqual(self.pr._session_nick(self.session()), self.nick)
+
+        session = self.session()
+        session.close()
+        with self.assertRaises(BadRequest):
+            self.pr._session_nick(session)
+        with self.assertRaises(BadRequest):
+            self.pr._session_nick(Session(self.ip))
+
+    def test__parse_public_key(self):
+        _parse_public_key = self.pr._parse_public_key
+        self.assertEqual(_parse_public_key(':'.join(self.key_strings)),
+                         self.pub_key)
+        for key in ('1', '1:2:3', 'n:e', None):
+            with self.assertRaises(BadRequest):
+                _parse_public_key(key)
 
+    def test__clean_up(self):
+        c = self.pr.db.cursor()
+        other_ip = 'other_ip'
+        user1 = '@other_user'
+        conns = {'ip1': FakeConnection()}
+        self.add_user(c, self.nick, friends = [user1])
+        self.add_user(c, user1, friends = [self.nick])
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
+        self.pr._add_session(self.nick, '1:2', other_ip)
+        self.pr._add_session(user1, '3:4', 'ip1')
+
+        self.pr._clean_up(self.ip, conns)
+        self.assertNotIn((self.nick, self.ip),
+                         self.pr.sessions.all(self.pr.db))
+        self.assertListEqual(self.pr.presence.ips(self.nick), [other_ip])
+        self.assertEqual(conns['ip1'].buffer, b'')
+
+        self.pr._clean_up(other_ip, conns)
+        self.assertFalse(self.pr.presence.is_online(self.nick))
+        self.assertEqual(conns['ip1'].buffer,
+                         self.pr._pack(sc.friends_group_update,
+                                       [], [self.nick], [], []))
+
+        self.pr._clean_up('ip1')
+        for i in (self.nick, user1):
+            c.execute('''DELETE FROM users
+                         WHERE name = %s''', (i,))
+        self.pr.db.commit()
+        c.close()
+
+    def test__flush_timestamps(self):
+        c = self.pr.db.cursor()
+        self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
+        self.pr._add_session('user1', '1:2', 'ip1')
+        c.execute('''UPDATE sessions SET last_active = 0''')
+        self.pr.db.commit()
+
+        self.pr._set_timestamp(self.ip)
+        self.pr._set_timestamp('ip1')
+        self.pr._set_timestamp('closed_ip')
+        c.execute('''SELECT last_active FROM sessions
+                     WHERE ip = %s''', (self.ip,))
+        self.assertEqual(c.fetchone()['last_active'], 0)
 
-        act_nick = _get_nick(self.ip)
-        self.assertEqual(self.nick, act_nick)
+        self.assertEqual(self.pr._flush_timestamps(), 2)
+        c.execute('''SELECT ip FROM sessions
+                     WHERE last_active >= %s''', (int(time.time()) - 60,))
+        self.assertListEqual(sorted(i['ip'] for i in c.fetchall()),
+                             ['ip1', self.ip])
+        self.assertEqual(self.pr._flush_timestamps(), 0)
 
         self.pr._close_session(self.ip)
-        with self.assertRaises(BadRequest):
-            _get_nick(self.ip)
+        self.pr._close_session('ip1')
+        c.close()
+
+    def test__reap_sessions(self):
+        c = self.pr.db.cursor()
+        user1 = '@other_user'
+        conns = {'ip1': FakeConnection()}
+        self.add_user(c, self.nick, friends = [user1])
+        self.add_user(c, user1, friends = [self.nick])
+        self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
+        self.pr._add_session(self.nick, '1:2', 'ip2')
+        self.pr._add_session(self.nick, '3:4', 'ip3')
+        self.pr._add_session(user1, '5:6', 'ip1')
+        c.execute('''UPDATE sessions SET last_active = 100
+                     WHERE name = %s''', (self.nick,))
+        c.execute('''UPDATE sessions SET last_active = 300
+                     WHERE name = %s''', (user1,))
+        self.pr.db.commit()
+
+        self.pr.reap_chunk = 2
+        reaped = self.pr._reap_sessions(200, conns)
+        del self.pr.reap_chunk
+        self.assertListEqual(sorted(reaped), ['ip2', 'ip3', self.ip])
+        c.execute('''SELECT ip FROM sessions''')
+        self.assertListEqual([i['ip'] for i in c.fetchall()], ['ip1'])
+        self.assertFalse(self.pr.presence.is_online(self.nick))
+        self.assertEqual(conns['ip1'].buffer,
+                         self.pr._pack(sc.friends_group_update,
+                                       [], [self.nick], [], []))
+        self.assertListEqual(self.pr._reap_sessions(200), [])
+
+        self.pr._close_session('ip1')
+        for i in (self.nick, user1):
+            c.execute('''DELETE FROM users
+                         WHERE name = %s''', (i,))
+        self.pr.db.commit()
+        c.close()
 
     def test__pack(self):
         act1 = self.pr._pack('0', 1, [(2, 3), 4])
@@ -167,6 +364,7 @@ class TestProcessor(unittest.TestCase):
         c.execute('''SELECT * FROM sessions
                      WHERE pub_key = %s''', (self.key_strings,))
         self.assertIsNone(c.fetchone())
+        self.assertFalse(self.pr.presence.is_online(self.nick))
         self.pr.db.commit()
         c.close()
 
@@ -174,24 +372,17 @@ class TestProcessor(unittest.TestCase):
         _remove_from = self.pr._remove_from
         c = self.pr.db.cursor()
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY['item'],
-                                     ARRAY[]::text[],
-                                     ARRAY['item1', 'item2'],
-                                     ARRAY['1', '2', '3'])''',
-                  (self.nick,))
+        self.add_user(c, self.nick, friends = ['item'],
+                      blacklist = ['item1', 'item2'],
+                      dialogs = ['1', '2', '3'])
 
         _remove_from(self.nick, 'item', 'friends')
         _remove_from(self.nick, 'item', 'favorites')
         _remove_from(self.nick, 'item1', 'blacklist')
         _remove_from(self.nick, '2', 'dialogs')
 
-        c.execute('''SELECT friends::text[],
-                            favorites::text[],
-                            blacklist::text[],
-                            dialogs::text[] FROM users
-                     WHERE name = %s''', (self.nick,))
-        row = tuple(c.fetchone())
+        row = tuple(self.get_relations(c, self.nick, i)
+                    for i in ('friends', 'favorites', 'blacklist', 'dialogs'))
         exp = ([], [], ['item2'], ['1', '3'])
         self.assertTupleEqual(row, exp)
 
@@ -207,12 +398,7 @@ class TestProcessor(unittest.TestCase):
         _is_blacklisted = self.pr._is_blacklisted
         c = self.pr.db.cursor()
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY['user1', 'user2'],
-                                     ARRAY[]::text[])''',
-                  (self.nick,))
+        self.add_user(c, self.nick, blacklist = ['user1', 'user2'])
 
         self.assertTrue(_is_blacklisted('user1', self.nick))
 
@@ -227,6 +413,29 @@ class TestProcessor(unittest.TestCase):
         self.pr.db.commit()
         c.close()
 
+    def test__related_users(self):
+        c = self.pr.db.cursor()
+        users = ['user{}'.format(i) for i in range(1, 7)]
+
+        self.add_user(c, self.nick, friends = ['user1'], blacklist = ['user6'])
+        self.add_user(c, 'user1', friends = [self.nick])
+        self.add_user(c, 'user2', blacklist = [self.nick])
+        for i in users[2:]:
+            self.add_user(c, i)
+        c.execute('''INSERT INTO requests
+                     VALUES (%s, 'user4', ''), ('user5', %s, '')''',
+                  (self.nick, self.nick))
+
+        self.assertListEqual(sorted(self.pr._related_users(self.nick)),
+                             ['user1', 'user2', 'user4', 'user5'])
+
+        c.execute('''DELETE FROM requests''')
+        for i in users + [self.nick]:
+            c.execute('''DELETE FROM users
+                         WHERE name = %s''', (i,))
+        self.pr.db.commit()
+        c.close()
+
     def test__remove_add_request(self):
         c = self.pr.db.cursor()
         _remove_add_request = self.pr._remove_add_request
@@ -248,24 +457,18 @@ class TestProcessor(unittest.TestCase):
         _add_to = self.pr._add_to
         c = self.pr.db.cursor()
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY['item'],
-                                     ARRAY[]::text[],
-                                     ARRAY['item1' ,'item2'],
-                                     ARRAY[]::text[])''',
-                  (self.nick,))
+        self.add_user(c, self.nick, friends = ['item'],
+                      blacklist = ['item1', 'item2'])
         self.pr.db.commit()
 
         _add_to(self.nick, 'item3', 'friends')
         _add_to(self.nick, 'item4', 'blacklist')
         _add_to(self.nick, 'item2', 'blacklist')
 
-        c.execute('''SELECT friends::text[], blacklist::text[]
-                     FROM users WHERE name = %s''', (self.nick,))
-
-        row = c.fetchone()
-        self.assertEqual(row['friends'], ['item', 'item3'])
-        self.assertEqual(row['blacklist'], ['item1', 'item2', 'item4'])
+        self.assertEqual(self.get_relations(c, self.nick, 'friends'),
+                         ['item', 'item3'])
+        self.assertEqual(self.get_relations(c, self.nick, 'blacklist'),
+                         ['item1', 'item2', 'item4'])
 
         c.execute('''DELETE FROM users
                      WHERE name = %s''', (self.nick,))
@@ -280,11 +483,8 @@ class TestProcessor(unittest.TestCase):
         _user_in_dialog = self.pr._user_in_dialog
         c = self.pr.db.cursor()
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY['item'],
-                                     ARRAY[]::text[],
-                                     ARRAY['item1' ,'item2'],
-                                     ARRAY['1', '2'])''', (self.nick,))
+        self.add_user(c, self.nick, friends = ['item'],
+                      blacklist = ['item1', 'item2'], dialogs = ['1', '2'])
 
         _user_in_dialog(self.nick, 2)
 
@@ -309,11 +509,7 @@ class TestProcessor(unittest.TestCase):
         user1 = '@first_user'
         user2 = '@other_user'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY['0', '1'])''', (self.nick,))
+        self.add_user(c, self.nick, dialogs = ['0', '1'])
 
         msgs = ('', '', '', '')
         times = (0, 0, 0, 0)
@@ -322,39 +518,36 @@ class TestProcessor(unittest.TestCase):
                 (user1, user2) * 2]
 
         for i in range(3):
-            c.execute('''CREATE TABLE "d{}" (content text,
-                                             timestamp bigint,
-                                             sender text)'''.format(i))
-            c.executemany('''INSERT INTO "d{}"
-                             VALUES (%s, %s, %s)'''.format(i),
-                          zip(msgs, times, usrs[i]))
+            c.execute('''INSERT INTO dialogs VALUES (%s)''', (i,))
+            c.executemany('''INSERT INTO messages (dialog, content,
+                                                   timestamp, sender)
+                             VALUES (%s, %s, %s, %s)''',
+                          zip((i,) * 4, msgs, times, usrs[i]))
 
         _delete_dialog(0, self.nick)
-        c.execute('''SELECT sender FROM "d0"''')
+        c.execute('''SELECT sender FROM messages WHERE dialog = 0''')
         senders = [i['sender'] for i in c.fetchall()]
         self.assertIn('~' + self.nick, senders)
         self.assertIn(user1, senders)
 
         _delete_dialog(1, self.nick)
-        c.execute('''SELECT table_name FROM information_schema.tables
-                     WHERE table_name = 'd1' AND table_schema = 'public' ''')
+        c.execute('''SELECT sender FROM messages WHERE dialog = 1''')
+        self.assertIsNone(c.fetchone())
+        c.execute('''SELECT id FROM dialogs WHERE id = 1''')
         self.assertIsNone(c.fetchone())
 
         _delete_dialog(2, self.nick)
-        c.execute('''SELECT sender FROM "d2"''')
+        c.execute('''SELECT sender FROM messages WHERE dialog = 2''')
         senders = [i['sender'] for i in c.fetchall()]
         self.assertIn(user2, senders)
         self.assertIn(user1, senders)
 
-        c.execute('''SELECT dialogs::text[] FROM users
-                     WHERE name = %s''', (self.nick,))
-
-        self.assertListEqual(c.fetchone()['dialogs'], [])
+        self.assertListEqual(self.get_relations(c, self.nick, 'dialogs'), [])
 
         c.execute('''DELETE FROM users
                      WHERE name = %s''', (self.nick,))
-        c.execute('''DROP TABLE "d0"''')
-        c.execute('''DROP TABLE "d2"''')
+        c.execute('''DELETE FROM messages''')
+        c.execute('''DELETE FROM dialogs''')
 
         self.pr.db.commit()
         c.close()
@@ -363,11 +556,7 @@ class TestProcessor(unittest.TestCase):
         _user_exists = self.pr._user_exists
         c = self.pr.db.cursor()
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (self.nick,))
+        self.add_user(c, self.nick)
 
         _user_exists(self.nick)
 
@@ -393,45 +582,42 @@ class TestProcessor(unittest.TestCase):
 
     def test__next_free_dialog(self):
         _nfd = self.pr._next_free_dialog
-        c = self.pr.db.cursor()
-
-        c.execute('''CREATE TABLE d0 (c int)''')
-        c.execute('''CREATE TABLE d2 (c int)''')
 
         free1 = _nfd()
-        self.assertEqual(free1, 1)
-
-        c.execute('''CREATE TABLE d1 (c int)''')
-
         free2 = _nfd()
-        self.assertEqual(free2, 3)
+        self.assertIsInstance(free1, int)
+        self.assertGreater(free2, free1)
 
-        for i in range(3):
-            c.execute('''DROP TABLE d{}'''.format(i))
-
-        self.pr.db.commit()
-        c.close()
+        # Номер не выдается повторно даже после отката транзакции
+        self.pr.db.rollback()
+        self.assertGreater(_nfd(), free2)
 
     def test_register(self):
         register = self.pr.register
         c = self.pr.db.cursor()
+        session = Session(self.ip)
 
         resp1 = self.unpack(register(self.request_id,
-                                     self.ip,
+                                     session,
                                      self.nick,
                                      self.pswd,
                                      ':'.join(self.key_strings)))
         exp1 = (sc.register_succ,
                 [self.request_id])
-        self.assertTupleEqual(resp1, exp1)
-
-        c.execute('''SELECT name, password, friends::text[],
-                            favorites::text[], blacklist::text[],
-                            dialogs::text[] FROM users
+        self.assertTupleEqual((resp1[0], resp1[1][:1]), exp1)
+        self.assertIn((self.nick, self.ip), self.pr.sessions.all(self.pr.db))
+        self.assertEqual(session.nick, self.nick)
+        self.assertEqual(session.pub_key, self.pub_key)
+        self.assertEqual((session.sym_key, session.mac_key),
+                         tuple(map(b64decode, resp1[1][1:])))
+
+        c.execute('''SELECT name, password FROM users
                      WHERE name = %s AND password = %s''',
                   (self.nick, self.pswd))
-        self.assertTupleEqual(tuple(c.fetchone()),
-                              (self.nick, self.pswd, [], [], [], [],))
+        self.assertTupleEqual(tuple(c.fetchone()), (self.nick, self.pswd))
+        c.execute('''SELECT * FROM relations
+                     WHERE owner = %s''', (self.nick,))
+        self.assertIsNone(c.fetchone())
 
         c.execute('''SELECT * FROM profiles
                      WHERE name = %s''', (self.nick,))
@@ -442,22 +628,30 @@ class TestProcessor(unittest.TestCase):
         self.assertTupleEqual(tuple(data),
                               (self.nick, '', '', 0, '', img))
 
-        resp2 = self.unpack(register(self.request_id,
-                                     self.ip,
-                                     self.nick,
-                                     self.pswd,
-                                     ':'.join(self.key_strings)))
+        resp2_tuple = register(self.request_id,
+                               Session(self.ip),
+                               self.nick,
+                               self.pswd,
+                               ':'.join(self.key_strings))
         exp2 = (sc.register_error,
                 [self.request_id])
-        self.assertTupleEqual(resp2, exp2)
+        self.assertTupleEqual(self.unpack(resp2_tuple[0]), exp2)
+        self.assertEqual(resp2_tuple[1], self.pub_key)
 
         resp3 = self.unpack(register(self.request_id,
-                                     self.ip,
+                                     Session(self.ip),
                                      '~' + self.nick,
                                      self.pswd,
-                                     ':'.join(self.key_strings)))
+                                     ':'.join(self.key_strings))[0])
         self.assertTupleEqual(resp3, exp2)
 
+        with self.assertRaises(BadRequest):
+            register(self.request_id,
+                     Session(self.ip),
+                     self.nick,
+                     self.pswd,
+                     'not a key')
+
         c.execute('''DELETE FROM profiles
                      WHERE name = %s''', (self.nick,))
         c.execute('''DELETE FROM users
@@ -469,25 +663,26 @@ class TestProcessor(unittest.TestCase):
     def test_login(self):
         login = self.pr.login
         c = self.pr.db.cursor()
+        session = Session(self.ip)
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, %s, ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''',
-                  (self.nick, self.pswd))
+        self.add_user(c, self.nick, pswd = self.pswd)
 
         resp1 = self.unpack(login(self.request_id,
-                                  self.ip,
+                                  session,
                                   self.nick,
                                   self.pswd,
                                   ':'.join(self.key_strings), {}))
         exp1 = (sc.login_succ,
                 [self.request_id])
-        self.assertEqual(resp1, exp1)
+        self.assertEqual((resp1[0], resp1[1][:1]), exp1)
+        self.assertIn((self.nick, self.ip), self.pr.sessions.all(self.pr.db))
+        self.assertEqual(session.nick, self.nick)
+        self.assertEqual(session.pub_key, self.pub_key)
+        self.assertEqual((session.sym_key, session.mac_key),
+                         tuple(map(b64decode, resp1[1][1:])))
 
         resp2_tuple = login(self.request_id,
-                            self.ip,
+                            session,
                             self.nick,
                             self.pswd,
                             ':'.join(self.key_strings), {})
@@ -500,7 +695,7 @@ class TestProcessor(unittest.TestCase):
                      WHERE name = %s''', (self.nick,))
 
         resp3 = self.unpack(login(self.request_id,
-                                  self.ip,
+                                  session,
                                   self.nick,
                                   self.pswd,
                                   ':'.join(self.key_strings), {})[0])
@@ -516,30 +711,14 @@ class TestProcessor(unittest.TestCase):
         c = self.pr.db.cursor()
         ip = 'other_ip'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY['user1'],
-                                     ARRAY['user1'],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (self.nick,))
+        self.add_user(c, self.nick, friends = ['user1'], favorites = ['user1'])
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
         self.pr._add_session('user2', '1:2', ip)
         users = ('user1', 'user10', 'user2', 'user4', 'user5')
         for i in users[1:]:
-            c.execute('''INSERT INTO users
-                         VALUES (%s, '', ARRAY[]::text[],
-                                         ARRAY[]::text[],
-                                         ARRAY[]::text[],
-                                         ARRAY[]::text[])''', (i,))
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[%s]::text[],
-                                     ARRAY[]::text[])''', ('user3', self.nick))
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[%s],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', ('user1', self.nick))
+            self.add_user(c, i)
+        self.add_user(c, 'user3', blacklist = [self.nick])
+        self.add_user(c, 'user1', friends = [self.nick])
 
         c.execute('''INSERT INTO requests
                      VALUES (%s, %s, '')''', (self.nick, 'user4'))
@@ -547,7 +726,7 @@ class TestProcessor(unittest.TestCase):
                      VALUES (%s, %s, '')''', ('user5', self.nick))
 
         resp = self.unpack(search_list(self.request_id,
-                                        self.ip))
+                                        self.session()))
         exp = (sc.search_list,
                [self.request_id,
                 [['user2', True], ['user10', False]]])
@@ -578,24 +757,17 @@ class TestProcessor(unittest.TestCase):
         _close_session = self.pr._close_session
         c = self.pr.db.cursor()
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY['user1', 'user10', 'user2'],
-                                     ARRAY['user2'],
-                                     ARRAY['user3'],
-                                     ARRAY[]::text[])''', (self.nick,))
+        self.add_user(c, self.nick, friends = ['user1', 'user10', 'user2'],
+                      favorites = ['user2'], blacklist = ['user3'])
         _add_session(self.nick, ':'.join(self.key_strings), self.ip)
         users = ('user1', 'user10', 'user2', 'users3')
         for i in users:
-            c.execute('''INSERT INTO users
-                         VALUES (%s, '', ARRAY[]::text[],
-                                         ARRAY[]::text[],
-                                         ARRAY[]::text[],
-                                         ARRAY[]::text[])''', (i,))
+            self.add_user(c, i)
         _add_session('user1', '1:2', '1.1.1.1')
         _add_session('user2', '3:4', '2.2.2.2')
 
         resp = self.unpack(friends_group(self.request_id,
-                                         self.ip))
+                                         self.session()))
         exp = (sc.friends_group_response,
                [self.request_id,
                 [[['user2', True]],
@@ -623,30 +795,26 @@ class TestProcessor(unittest.TestCase):
         message_history = self.pr.message_history
         c = self.pr.db.cursor()
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY['0'])''', (self.nick,))
+        self.add_user(c, self.nick, dialogs = ['0'])
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
-        c.execute('''CREATE TABLE "d0" (content text,
-                                        timestamp bigint,
-                                        sender text)''')
+        c.execute('''INSERT INTO dialogs VALUES (0)''')
 
         msgs = []
         for i in range(5):
-            c.execute('''INSERT INTO "d0"
-                         VALUES (%s, %s, %s)''', (str(i), 50 * i, self.nick))
-            msgs.append([str(i), i * 50, self.nick])
+            c.execute('''INSERT INTO messages (dialog, content,
+                                               timestamp, sender)
+                         VALUES (0, %s, %s, %s)
+                         RETURNING id''', (str(i), 50 * i, self.nick))
+            msgs.append([c.fetchone()['id'], str(i), i * 50, self.nick])
 
         with self.assertRaises(BadRequest):
             message_history(self.request_id,
-                            self.ip,
+                            self.session(),
                             -1,
                             0)
 
         resp1 = self.unpack(message_history(self.request_id,
-                                            self.ip,
+                                            self.session(),
                                             2,
                                             0))
         exp1 = (sc.message_history,
@@ -654,16 +822,121 @@ class TestProcessor(unittest.TestCase):
         self.assertTupleEqual(resp1, exp1)
 
         resp2 = self.unpack(message_history(self.request_id,
-                                            self.ip,
+                                            self.session(),
                                             0,
                                             0))
         exp2 = (sc.message_history,
                 [self.request_id, msgs])
         self.assertTupleEqual(resp2, exp2)
 
+        resp3 = self.unpack(message_history(self.request_id,
+                                            self.session(),
+                                            10,
+                                            0))
+        self.assertTupleEqual(resp3, exp2)
+
+        resp4 = self.unpack(message_history(self.request_id,
+                                            self.session(),
+                                            2,
+                                            0,
+                                            msgs[3][0]))
+        exp4 = (sc.message_history,
+                [self.request_id, msgs[1:3]])
+        self.assertTupleEqual(resp4, exp4)
+
+        resp5 = self.unpack(message_history(self.request_id,
+                                            self.session(),
+                                            2,
+                                            0,
+                                            None,
+                                            msgs[1][0]))
+        exp5 = (sc.message_history,
+                [self.request_id, msgs[2:4]])
+        self.assertTupleEqual(resp5, exp5)
+
+        resp6 = self.unpack(message_history(self.request_id,
+                                            self.session(),
+                                            0,
+                                            0,
+                                            None,
+                                            msgs[1][0]))
+        exp6 = (sc.message_history,
+                [self.request_id, msgs[2:]])
+        self.assertTupleEqual(resp6, exp6)
+
+        with self.assertRaises(BadRequest):
+            message_history(self.request_id,
+                            self.session(),
+                            2,
+                            0,
+                            'last')
+
+        c.execute('''DELETE FROM users
+                     WHERE name = %s''', (self.nick,))
+        c.execute('''DELETE FROM messages''')
+        c.execute('''DELETE FROM dialogs''')
+        self.pr._close_session(self.ip)
+
+        self.pr.db.commit()
+        c.close()
+
+    def test_sync(self):
+        sync = self.pr.sync
+        c = self.pr.db.cursor()
+
+        self.add_user(c, self.nick, dialogs = ['0', '1'])
+        self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
+        c.execute('''INSERT INTO dialogs VALUES (0), (1), (2)''')
+
+        msgs = []
+        for dialog in (0, 1, 2, 0, 1):
+            c.execute('''INSERT INTO messages (dialog, content,
+                                               timestamp, sender)
+                         VALUES (%s, 'msg', 0, %s)
+                         RETURNING id''', (dialog, self.nick))
+            msgs.append([dialog, c.fetchone()['id'], 'msg', 0, self.nick])
+
+        resp1 = self.unpack(sync(self.request_id,
+                                 self.session(),
+                                 msgs[0][1]))
+        exp1 = (sc.sync_result,
+                [self.request_id, [msgs[3], msgs[1], msgs[4]], []])
+        self.assertTupleEqual(resp1, exp1)
+
+        resp2 = self.unpack(sync(self.request_id,
+                                 self.session(),
+                                 {'0': msgs[3][1]}))
+        exp2 = (sc.sync_result,
+                [self.request_id, [msgs[1], msgs[4]], []])
+        self.assertTupleEqual(resp2, exp2)
+
+        # Из диалога передается не больше sync_limit сообщений
+        self.pr.sync_limit = 1
+        resp4 = self.unpack(sync(self.request_id,
+                                 self.session(),
+                                 0))
+        exp4 = (sc.sync_result,
+                [self.request_id, [msgs[0], msgs[1]], [0, 1]])
+        self.assertTupleEqual(resp4, exp4)
+        del self.pr.sync_limit
+
+        resp3 = self.unpack(sync(self.request_id,
+                                 self.session(),
+                                 {'0': msgs[3][1], '1': msgs[4][1]}))
+        exp3 = (sc.sync_result,
+                [self.request_id, [], []])
+        self.assertTupleEqual(resp3, exp3)
+
+        for watermarks in ('0', {'d0': 0}, {'0': '0'}):
+            with self.assertRaises(BadRequest):
+                sync(self.request_id,
+                     self.session(),
+                     watermarks)
+
         c.execute('''DELETE FROM users
                      WHERE name = %s''', (self.nick,))
-        c.execute('''DROP TABLE "d0"''')
+        c.execute('''DELETE FROM messages''')
+        c.execute('''DELETE FROM dialogs''')
         self.pr._close_session(self.ip)
 
         self.pr.db.commit()
@@ -674,55 +947,47 @@ class TestProcessor(unittest.TestCase):
         c = self.pr.db.cursor()
         other_user = '@other_user'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY['0'])''', (self.nick,))
+        self.add_user(c, self.nick, dialogs = ['0'])
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
-        c.execute('''CREATE TABLE "d0" (content text,
-                                        timestamp bigint,
-                                        sender text)''')
-        c.execute('''INSERT INTO "d0"
-                     VALUES ('0', 0, %s)''', (self.nick,))
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[%s],
-                                     ARRAY[]::text[])''',
-                  (other_user, self.nick))
+        c.execute('''INSERT INTO dialogs VALUES (0)''')
+        c.execute('''INSERT INTO messages (dialog, content,
+                                           timestamp, sender)
+                     VALUES (0, '0', 0, %s)''', (self.nick,))
+        self.add_user(c, other_user, blacklist = [self.nick])
 
         msg_args = ['test', int(time.time() * 100), 0]
         resp1 = self.unpack(send_message(self.request_id,
-                                         self.ip,
+                                         self.session(),
                                          *msg_args, {}))
         exp1 = (sc.message_received,
                 [self.request_id])
         self.assertTupleEqual(resp1, exp1)
 
         msg_args = msg_args[:2] + [self.nick]
-        c.execute('''SELECT * FROM "d0"
-                     WHERE content = %s AND timestamp = %s
+        c.execute('''SELECT * FROM messages
+                     WHERE dialog = 0 AND content = %s AND timestamp = %s
                      AND sender = %s''', msg_args)
         self.assertIsNotNone(c.fetchone())
 
         with self.assertRaises(BadRequest):
             send_message(self.request_id,
-                         self.ip,
+                         self.session(),
                          '0' * 1001,
                          0,
                          self.nick, {})
 
-        c.execute('''INSERT INTO "d0"
-                     VALUES ('0', 0, %s)''', (other_user,))
+        c.execute('''INSERT INTO messages (dialog, content,
+                                           timestamp, sender)
+                     VALUES (0, '0', 0, %s)''', (other_user,))
         with self.assertRaises(BadRequest):
             send_message(self.request_id,
-                         self.ip,
+                         self.session(),
                          *msg_args, {})
 
         c.execute('''DELETE FROM users
                      WHERE name = %s''', (self.nick,))
-        c.execute('''DROP TABLE "d0"''')
+        c.execute('''DELETE FROM messages''')
+        c.execute('''DELETE FROM dialogs''')
         c.execute('''DELETE FROM users
                      WHERE name = %s''', (other_user,))
         self.pr._close_session(self.ip)
@@ -730,22 +995,48 @@ class TestProcessor(unittest.TestCase):
         self.pr.db.commit()
         c.close()
 
+    def test_send_message_notification(self):
+        c = self.pr.db.cursor()
+        other_user = '@other_user'
+        other_ip = 'other_ip'
+        conns = {self.ip: FakeConnection(),
+                 other_ip: FakeConnection()}
+
+        self.add_user(c, self.nick, dialogs = ['0'])
+        self.add_user(c, other_user, dialogs = ['0'])
+        c.execute('''INSERT INTO dialogs VALUES (0)''')
+        self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
+        self.pr._add_session(other_user, ':'.join(self.key_strings),
+                             other_ip)
+
+        self.pr.send_message(self.request_id, self.session(),
+                             'test', 0, 0, conns)
+        self.assertEqual(conns[other_ip].buffer,
+                         str(sc.new_message).encode())
+        self.assertEqual(conns[self.ip].buffer, b'')
+
+        c.execute('''DELETE FROM messages''')
+        c.execute('''DELETE FROM dialogs''')
+        c.execute('''DELETE FROM users
+                     WHERE name IN (%s, %s)''', (self.nick, other_user))
+        self.pr._close_session(self.ip)
+        self.pr._close_session(other_ip)
+
+        self.pr.db.commit()
+        c.close()
+
     def test_change_profile_section(self):
         change_profile_section = self.pr.change_profile_section
         c = self.pr.db.cursor()
         change = 'test'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (self.nick,))
+        self.add_user(c, self.nick)
         c.execute('''INSERT INTO profiles
                      VALUES (%s, '', '', 0, '', E'')''', (self.nick,))
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
 
         resp = self.unpack(change_profile_section(self.request_id,
-                                                  self.ip,
+                                                  self.session(),
                                                   0,
                                                   change))
         exp = (sc.change_profile_section_succ,
@@ -758,13 +1049,13 @@ class TestProcessor(unittest.TestCase):
 
         with self.assertRaises(BadRequest):
             change_profile_section(self.request_id,
-                                   self.ip,
+                                   self.session(),
                                    2,
                                    'not_int')
 
         with self.assertRaises(BadRequest):
             change_profile_section(self.request_id,
-                                   self.ip,
+                                   self.session(),
                                    4,
                                    b'PNG')
 
@@ -783,50 +1074,34 @@ class TestProcessor(unittest.TestCase):
         user1 = '@other_user'
         user2 = '@first_user'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[%s],
-                                     ARRAY[%s],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''',
-                  (self.nick, user1, user1))
+        self.add_user(c, self.nick, friends = [user1], favorites = [user1])
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (user1,))
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (user2,))
+        self.add_user(c, user1)
+        self.add_user(c, user2)
         c.execute('''INSERT INTO requests
                      VALUES (%s, %s, '')''', (self.nick, user2))
 
         resp = self.unpack(add_to_blacklist(self.request_id,
-                                            self.ip,
+                                            self.session(),
                                             user1, {}))
         exp = (sc.add_to_blacklist_succ,
                [self.request_id])
         self.assertTupleEqual(resp, exp)
 
         add_to_blacklist(self.request_id,
-                         self.ip,
+                         self.session(),
                          user2, {})
 
         with self.assertRaises(BadRequest):
             add_to_blacklist(self.request_id,
-                             self.ip,
+                             self.session(),
                              self.nick, {})
 
-        c.execute('''SELECT friends::text[],
-                            favorites::text[],
-                            blacklist::text[] FROM users
-                     WHERE name = %s''', (self.nick,))
-        row = c.fetchone()
-        self.assertListEqual(row['friends'], [])
-        self.assertListEqual(row['favorites'], [])
-        self.assertListEqual(row['blacklist'], [user1, user2])
+        self.assertListEqual(self.get_relations(c, self.nick, 'friends'), [])
+        self.assertListEqual(self.get_relations(c, self.nick, 'favorites'),
+                             [])
+        self.assertListEqual(self.get_relations(c, self.nick, 'blacklist'),
+                             [user1, user2])
 
         c.execute('''SELECT * FROM requests
                      WHERE from_who = %s AND to_who = %s''',
@@ -846,32 +1121,20 @@ class TestProcessor(unittest.TestCase):
         c = self.pr.db.cursor()
         user1 = '@other_user'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[%s],
-                                     ARRAY[%s],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''',
-                  (self.nick, user1, user1))
+        self.add_user(c, self.nick, friends = [user1], favorites = [user1])
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (user1,))
+        self.add_user(c, user1)
 
         resp = self.unpack(delete_from_friends(self.request_id,
-                                               self.ip,
+                                               self.session(),
                                                user1, {}))
         exp = (sc.delete_from_friends_succ,
                [self.request_id])
         self.assertTupleEqual(resp, exp)
 
-        c.execute('''SELECT friends::text[],
-                            favorites::text[] FROM users
-                     WHERE name = %s''', (self.nick,))
-        row = c.fetchone()
-        self.assertListEqual(row['friends'], [])
-        self.assertListEqual(row['favorites'], [])
+        self.assertListEqual(self.get_relations(c, self.nick, 'friends'), [])
+        self.assertListEqual(self.get_relations(c, self.nick, 'favorites'),
+                             [])
 
         c.execute('''DELETE FROM users
                      WHERE name = %s''', (self.nick,))
@@ -887,20 +1150,12 @@ class TestProcessor(unittest.TestCase):
         c = self.pr.db.cursor()
         user1 = '@other_user'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (self.nick,))
+        self.add_user(c, self.nick)
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (user1,))
+        self.add_user(c, user1)
 
         resp = self.unpack(send_request(self.request_id,
-                                        self.ip,
+                                        self.session(),
                                         user1,
                                         '', {}))
         exp = (sc.send_request_succ,
@@ -914,7 +1169,7 @@ class TestProcessor(unittest.TestCase):
 
         with self.assertRaises(BadRequest):
             send_request(self.request_id,
-                         self.ip,
+                         self.session(),
                          user1,
                          '', {})
 
@@ -925,7 +1180,7 @@ class TestProcessor(unittest.TestCase):
         self.pr._add_to(user1, self.nick, 'friends')
         with self.assertRaises(BadRequest):
             send_request(self.request_id,
-                         self.ip,
+                         self.session(),
                          user1,
                          '', {})
 
@@ -933,7 +1188,7 @@ class TestProcessor(unittest.TestCase):
         self.pr._add_to(user1, self.nick, 'friends')
         with self.assertRaises(BadRequest):
             send_request(self.request_id,
-                         self.ip,
+                         self.session(),
                          user1,
                          '', {})
 
@@ -954,41 +1209,29 @@ class TestProcessor(unittest.TestCase):
         user3 = '@second_user'
         user4 = '@last_user'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[%s],
-                                     ARRAY[%s],
-                                     ARRAY[]::text[],
-                                     ARRAY['0'])''',
-                  (self.nick, user1, user1))
+        self.add_user(c, self.nick, friends = [user1], favorites = [user1],
+                      dialogs = ['0'])
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
         c.execute('''INSERT INTO profiles
                      VALUES (%s, '', '', 0, '', E'')''', (self.nick,))
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[%s],
-                                     ARRAY[%s],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''',
-                  (user1, self.nick, self.nick))
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[%s],
-                                     ARRAY[]::text[])''', (user2, self.nick))
-        c.execute('''CREATE TABLE "d0" (content text,
-                                        timestamp bigint,
-                                        sender text)''')
-        c.execute('''INSERT INTO "d0"
-                     VALUES ('', 0, %s)''', (self.nick,))
+        self.add_user(c, user1, friends = [self.nick], favorites = [self.nick])
+        self.add_user(c, user2, blacklist = [self.nick])
+        c.execute('''INSERT INTO dialogs VALUES (0)''')
+        c.execute('''INSERT INTO messages (dialog, content,
+                                           timestamp, sender)
+                     VALUES (0, '', 0, %s)''', (self.nick,))
         c.execute('''INSERT INTO requests
                      VALUES (%s, %s, '')''', (user3, self.nick))
         c.execute('''INSERT INTO requests
                      VALUES (%s, %s, '')''', (self.nick, user4))
 
+        session = self.session()
         resp = self.unpack(delete_profile(self.request_id,
-                                          self.ip, {}))
+                                          session, {}))
         exp = (sc.delete_profile_succ,
                [self.request_id])
         self.assertTupleEqual(resp, exp)
+        self.assertFalse(session.logged_in)
 
         c.execute('''SELECT * FROM users
                      WHERE name = %s''', (self.nick,))
@@ -998,18 +1241,13 @@ class TestProcessor(unittest.TestCase):
                      WHERE name = %s''', (self.nick,))
         self.assertIsNone(c.fetchone())
 
-        c.execute('''SELECT friends::text[],
-                            favorites::text[] FROM users
-                     WHERE name = %s''', (user1,))
-        for i in c.fetchone():
-            self.assertListEqual(i, [])
-
-        c.execute('''SELECT blacklist::text[] FROM users
-                     WHERE name = %s''', (user2,))
-        self.assertListEqual(c.fetchone()['blacklist'], [])
+        self.assertListEqual(self.get_relations(c, user1, 'friends'), [])
+        self.assertListEqual(self.get_relations(c, user1, 'favorites'), [])
+        self.assertListEqual(self.get_relations(c, user2, 'blacklist'), [])
 
-        c.execute('''SELECT table_name FROM information_schema.tables
-                     WHERE table_name = 'd0' and table_schema = 'public' ''')
+        c.execute('''SELECT id FROM dialogs WHERE id = 0''')
+        self.assertIsNone(c.fetchone())
+        c.execute('''SELECT id FROM messages WHERE dialog = 0''')
         self.assertIsNone(c.fetchone())
 
         c.execute('''SELECT * FROM requests
@@ -1034,19 +1272,42 @@ class TestProcessor(unittest.TestCase):
         logout = self.pr.logout
         c = self.pr.db.cursor()
 
+        user1 = '@other_user'
+        user2 = '@first_user'
+        conns = {'ip1': FakeConnection(),
+                 'ip2': FakeConnection()}
+
+        self.add_user(c, self.nick, friends = [user1])
+        self.add_user(c, user1, friends = [self.nick])
+        self.add_user(c, user2)
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
+        self.pr._add_session(user1, '1:2', 'ip1')
+        self.pr._add_session(user2, '3:4', 'ip2')
 
+        session = self.session()
         resp = self.unpack(logout(self.request_id,
-                                  self.ip, {}))
+                                  session, conns))
         exp = (sc.logout_succ,
                [self.request_id])
         self.assertTupleEqual(resp, exp)
+        self.assertFalse(session.logged_in)
 
         c.execute('''SELECT * FROM sessions
                      WHERE ip = %s''', (self.ip,))
         self.assertIsNone(c.fetchone())
 
+        self.assertEqual(conns['ip1'].buffer,
+                         self.pr._pack(sc.friends_group_update,
+                                       [], [self.nick], [], []))
+        self.assertEqual(conns['ip2'].buffer, b'')
+
+        for i in (self.nick, user1, user2):
+            c.execute('''DELETE FROM users
+                         WHERE name = %s''', (i,))
+        self.pr._close_session('ip1')
+        self.pr._close_session('ip2')
         self.pr.db.commit()
+        c.close()
 
     def test_create_dialog(self):
         create_dialog = self.pr.create_dialog
@@ -1055,68 +1316,41 @@ class TestProcessor(unittest.TestCase):
         user2 = '@first_user'
         user3 = '@second_user'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', %s,
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY['0'])''',
-                  (self.nick, [user1, user2]))
+        self.add_user(c, self.nick, friends = [user1, user2], dialogs = ['0'])
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[%s],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (user1, self.nick))
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[%s],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY['0'])''', (user2, self.nick))
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (user3,))
-        c.execute('''CREATE TABLE "d0" (content text,
-                                        timestamp bigint,
-                                        sender text)''')
+        self.add_user(c, user1, friends = [self.nick])
+        self.add_user(c, user2, friends = [self.nick], dialogs = ['0'])
+        self.add_user(c, user3)
+        c.execute('''INSERT INTO dialogs VALUES (0)''')
 
         resp1 = self.unpack(create_dialog(self.request_id,
-                                         self.ip,
+                                         self.session(),
                                          user1))
+        new_dialog = resp1[1][1]
         exp1 = (sc.create_dialog_succ,
-                [self.request_id, 1])
+                [self.request_id, new_dialog])
         self.assertTupleEqual(resp1, exp1)
+        self.assertNotEqual(new_dialog, 0)
 
         resp2 = self.unpack(create_dialog(self.request_id,
-                                          self.ip,
+                                          self.session(),
                                           user2))
         exp2 = (sc.create_dialog_succ,
                 [self.request_id, 0])
         self.assertTupleEqual(resp2, exp2)
-        c.execute('''SELECT dialogs::text[] FROM users
-                     WHERE name = %s''', (user1,))
-        dlg1 = c.fetchone()['dialogs']
-        c.execute('''SELECT dialogs::text[] FROM users
-                     WHERE name = %s''', (user2,))
-        dlg2 = c.fetchone()['dialogs']
-        c.execute('''SELECT dialogs::text[] FROM users
-                     WHERE name = %s''', (self.nick,))
-        dlg_main = c.fetchone()['dialogs']
+        dlg1 = self.get_relations(c, user1, 'dialogs')
+        dlg2 = self.get_relations(c, user2, 'dialogs')
+        dlg_main = self.get_relations(c, self.nick, 'dialogs')
         self.assertListEqual(dlg_main, dlg2 + dlg1)
 
-        dlg1_name = 'd' + str(dlg1[0])
-        dlg2_name = 'd' + str(dlg2[0])
-
-        c.execute('''SELECT table_name FROM information_schema.tables
-                     WHERE table_name = %s OR table_name = %s
-                     AND table_schema = 'public' ''',
-                  (dlg1_name, dlg2_name))
+        c.execute('''SELECT id FROM dialogs
+                     WHERE id = %s OR id = %s''',
+                  (int(dlg1[0]), int(dlg2[0])))
         self.assertEqual(len(c.fetchall()), 2)
 
         with self.assertRaises(BadRequest):
             create_dialog(self.request_id,
-                          self.ip,
+                          self.session(),
                           user3)
 
         c.execute('''DELETE FROM users
@@ -1127,8 +1361,7 @@ class TestProcessor(unittest.TestCase):
                      WHERE name = %s''', (user2,))
         c.execute('''DELETE FROM users
                      WHERE name = %s''', (user3,))
-        c.execute('''DROP TABLE "d0"''')
-        c.execute('''DROP TABLE "{}"'''.format(dlg1_name))
+        c.execute('''DELETE FROM dialogs''')
         self.pr._close_session(self.ip)
 
         self.pr.db.commit()
@@ -1141,23 +1374,15 @@ class TestProcessor(unittest.TestCase):
         email = 'email'
         user1 = '@other_user'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (self.nick,))
+        self.add_user(c, self.nick)
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
         c.execute('''INSERT INTO profiles
                      VALUES (%s, %s, %s, 0, '', E'FF')''',
                   (self.nick, status, email))
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[%s],
-                                     ARRAY[]::text[])''', (user1, self.nick))
+        self.add_user(c, user1, blacklist = [self.nick])
 
         resp = self.unpack(profile_info(self.request_id,
-                                        self.ip,
+                                        self.session(),
                                         self.nick))
         exp = (sc.profile_info,
                [self.request_id,
@@ -1170,7 +1395,7 @@ class TestProcessor(unittest.TestCase):
 
         with self.assertRaises(BadRequest):
             profile_info(self.request_id,
-                         self.ip,
+                         self.session(),
                          user1)
 
         c.execute('''DELETE FROM profiles
@@ -1189,28 +1414,19 @@ class TestProcessor(unittest.TestCase):
         c = self.pr.db.cursor()
         user1 = '@other_user'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[%s],
-                                     ARRAY[]::text[])''', (self.nick, user1))
+        self.add_user(c, self.nick, blacklist = [user1])
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (user1,))
+        self.add_user(c, user1)
 
         resp = self.unpack(remove_from_blacklist(self.request_id,
-                                                 self.ip,
+                                                 self.session(),
                                                  user1, {}))
         exp = (sc.remove_from_blacklist_succ,
                [self.request_id])
         self.assertTupleEqual(resp, exp)
 
-        c.execute('''SELECT blacklist::text[] FROM users
-                     WHERE name = %s''', (self.nick,))
-        self.assertListEqual(c.fetchone()['blacklist'], [])
+        self.assertListEqual(self.get_relations(c, self.nick, 'blacklist'),
+                             [])
 
         c.execute('''DELETE FROM users
                      WHERE name = %s OR name = %s''', (self.nick, user1))
@@ -1224,22 +1440,14 @@ class TestProcessor(unittest.TestCase):
         c = self.pr.db.cursor()
         user1 = '@other_user'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (self.nick,))
+        self.add_user(c, self.nick)
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (user1,))
+        self.add_user(c, user1)
         c.execute('''INSERT INTO requests
                      VALUES (%s, %s, '')''', (self.nick, user1))
 
         resp = self.unpack(take_request_back(self.request_id,
-                                             self.ip,
+                                             self.session(),
                                              user1, {}))
         exp = (sc.take_request_back_succ,
                [self.request_id])
@@ -1263,42 +1471,35 @@ class TestProcessor(unittest.TestCase):
         user1 = '@other_user'
         user2 = '@first_user'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[%s],
-                                     ARRAY[]::text[])''', (self.nick, user2))
+        self.add_user(c, self.nick, blacklist = [user2])
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (user1,))
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (user2,))
+        self.add_user(c, user1)
+        self.add_user(c, user2)
         c.execute('''INSERT INTO requests
                      VALUES (%s, %s, '')''', (user1, self.nick))
         c.execute('''INSERT INTO requests
                      VALUES (%s, %s, '')''', (user2, self.nick))
 
+        self.pr._add_session(user1, '1:2', 'ip1')
+        conns = {'ip1': FakeConnection()}
+
         resp = self.unpack(confirm_add_request(self.request_id,
-                                               self.ip,
-                                               user1, {}))
+                                               self.session(),
+                                               user1, conns))
         exp = (sc.confirm_add_request_succ,
                [self.request_id])
         self.assertTupleEqual(resp, exp)
 
-        c.execute('''SELECT friends::text[] FROM users
-                     WHERE name = %s''', (user1,))
-        fr1 = c.fetchone()['friends']
+        ntf = self.unpack(conns['ip1'].buffer)
+        exp_ntf = (sc.friends_group_update,
+                   [[], [], [['friends', self.nick, True]],
+                    [['outgoing', self.nick]]])
+        self.assertTupleEqual(ntf, exp_ntf)
+
+        fr1 = self.get_relations(c, user1, 'friends')
         self.assertListEqual(fr1, [self.nick])
 
-        c.execute('''SELECT friends::text[] FROM users
-                     WHERE name = %s''', (self.nick,))
-        fr_main = c.fetchone()['friends']
+        fr_main = self.get_relations(c, self.nick, 'friends')
         self.assertListEqual(fr_main, [user1])
 
         c.execute('''SELECT * FROM requests
@@ -1308,7 +1509,7 @@ class TestProcessor(unittest.TestCase):
 
         with self.assertRaises(BadRequest):
             confirm_add_request(self.request_id,
-                                self.ip,
+                                self.session(),
                                 user2, {})
 
         c.execute('''DELETE FROM users
@@ -1319,6 +1520,7 @@ class TestProcessor(unittest.TestCase):
                      WHERE name = %s''', (user2,))
         c.execute('''DELETE FROM requests
                      WHERE from_who = %s''', (user2,))
+        self.pr._close_session('ip1')
         self.pr._close_session(self.ip)
 
         self.pr.db.commit()
@@ -1329,28 +1531,19 @@ class TestProcessor(unittest.TestCase):
         c = self.pr.db.cursor()
         user1 = '@other_user'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[%s],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (self.nick, user1))
+        self.add_user(c, self.nick, friends = [user1])
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[%s],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (user1, self.nick))
+        self.add_user(c, user1, friends = [self.nick])
 
         resp = self.unpack(add_to_favorites(self.request_id,
-                                            self.ip,
+                                            self.session(),
                                             user1))
         exp = (sc.add_to_favorites_succ,
                [self.request_id])
         self.assertTupleEqual(resp, exp)
 
-        c.execute('''SELECT favorites::text[] FROM users
-                     WHERE name = %s''', (self.nick,))
-        self.assertListEqual(c.fetchone()['favorites'], [user1])
+        self.assertListEqual(self.get_relations(c, self.nick, 'favorites'),
+                             [user1])
 
         c.execute('''DELETE FROM users
                      WHERE name = %s''', (self.nick,))
@@ -1371,20 +1564,18 @@ class TestProcessor(unittest.TestCase):
                     ['look above', 90, self.nick],
                     ['nothing to see', 100, self.nick]]
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY['0'])''', (self.nick,))
+        self.add_user(c, self.nick, dialogs = ['0'])
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
-        c.execute('''CREATE TABLE "d0" (content text,
-                                        timestamp bigint,
-                                        sender text)''')
-        c.executemany('''INSERT INTO "d0"
-                         VALUES (%s, %s, %s)''', messages)
+        c.execute('''INSERT INTO dialogs VALUES (0)''')
+        for i in messages:
+            c.execute('''INSERT INTO messages (dialog, content,
+                                               timestamp, sender)
+                         VALUES (0, %s, %s, %s)
+                         RETURNING id''', i)
+            i.insert(0, c.fetchone()['id'])
 
         resp1 = self.unpack(search_msg(self.request_id,
-                                       self.ip,
+                                       self.session(),
                                        0,
                                        'test_mess',
                                        50,
@@ -1395,7 +1586,7 @@ class TestProcessor(unittest.TestCase):
         self.assertTupleEqual(resp1, exp1)
 
         resp2 = self.unpack(search_msg(self.request_id,
-                                       self.ip,
+                                       self.session(),
                                        0,
                                        'look',
                                        50,
@@ -1406,7 +1597,7 @@ class TestProcessor(unittest.TestCase):
         self.assertTupleEqual(resp2, exp2)
 
         resp3 = self.unpack(search_msg(self.request_id,
-                                       self.ip,
+                                       self.session(),
                                        0,
                                        'look nowhere',
                                        0,
@@ -1418,7 +1609,7 @@ class TestProcessor(unittest.TestCase):
 
         with self.assertRaises(BadRequest):
             search_msg(self.request_id,
-                       self.ip,
+                       self.session(),
                        0,
                        'smth',
                        100,
@@ -1426,7 +1617,8 @@ class TestProcessor(unittest.TestCase):
 
         c.execute('''DELETE FROM users
                      WHERE name = %s''', (self.nick,))
-        c.execute('''DROP TABLE "d0"''')
+        c.execute('''DELETE FROM messages''')
+        c.execute('''DELETE FROM dialogs''')
         self.pr._close_session(self.ip)
 
         self.pr.db.commit()
@@ -1437,32 +1629,19 @@ class TestProcessor(unittest.TestCase):
         c = self.pr.db.cursor()
         user1 = '@other_user'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[%s],
-                                     ARRAY[%s],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''',
-                  (self.nick, user1, user1))
+        self.add_user(c, self.nick, friends = [user1], favorites = [user1])
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[%s],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (user1, self.nick))
+        self.add_user(c, user1, friends = [self.nick])
 
         resp = self.unpack(remove_from_favorites(self.request_id,
-                                                 self.ip,
+                                                 self.session(),
                                                  user1))
         exp = (sc.remove_from_favorites_succ,
                [self.request_id])
         self.assertTupleEqual(resp, exp)
 
-        c.execute('''SELECT friends::text[],
-                            favorites::text[] FROM users
-                     WHERE name = %s''', (self.nick,))
-        row = c.fetchone()
-        self.assertEqual(row['favorites'], [])
-        self.assertEqual(row['friends'], [user1])
+        self.assertEqual(self.get_relations(c, self.nick, 'favorites'), [])
+        self.assertEqual(self.get_relations(c, self.nick, 'friends'), [user1])
 
         c.execute('''DELETE FROM users
                      WHERE name = %s OR name = %s''', (self.nick, user1))
@@ -1478,11 +1657,7 @@ class TestProcessor(unittest.TestCase):
         user2 = '@first_user'
         ip = 'other_ip'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (self.nick,))
+        self.add_user(c, self.nick)
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
         self.pr._add_session(user2, '1:2', ip)
         c.execute('''INSERT INTO requests
@@ -1493,7 +1668,7 @@ class TestProcessor(unittest.TestCase):
                      VALUES (%s, %s, 'bye')''', (self.nick, user2))
 
         resp = self.unpack(add_requests(self.request_id,
-                                        self.ip))
+                                        self.session()))
         exp = (sc.add_requests,
                [self.request_id,
                 [[[user1, 'hello', False]],
@@ -1516,22 +1691,14 @@ class TestProcessor(unittest.TestCase):
         c = self.pr.db.cursor()
         user1 = '@other_user'
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (self.nick,))
+        self.add_user(c, self.nick)
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (user1,))
+        self.add_user(c, user1)
         c.execute('''INSERT INTO requests
                      VALUES (%s, %s, '')''', (user1, self.nick))
 
         resp = self.unpack(decline_add_request(self.request_id,
-                                               self.ip,
+                                               self.session(),
                                                user1, {}))
         exp = (sc.decline_add_request_succ,
                [self.request_id])
@@ -1556,17 +1723,13 @@ class TestProcessor(unittest.TestCase):
         c = self.pr.db.cursor()
         img = b64encode(b'PNG')
 
-        c.execute('''INSERT INTO users
-                     VALUES (%s, '', ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[],
-                                     ARRAY[]::text[])''', (self.nick,))
+        self.add_user(c, self.nick)
         c.execute('''INSERT INTO profiles
                      VALUES (%s, '', '', 0, '', E'')''', (self.nick,))
         self.pr._add_session(self.nick, ':'.join(self.key_strings), self.ip)
 
         resp = self.unpack(set_image(self.request_id,
-                                     self.ip,
+                                     self.session(),
                                      img))
         exp = (sc.set_image_succ,
                [self.request_id])
@@ -0,0 +1,43 @@
+import unittest
+from unittest.mock import patch
+from ratelimit import RateLimiter
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_allow(self):
+        limiter = RateLimiter(2, 3)
+        with patch('ratelimit.time.monotonic', return_value = 100.0):
+            for i in range(3):
+                self.assertTrue(limiter.allow('1.1.1.1'))
+            self.assertFalse(limiter.allow('1.1.1.1'))
+            # Запас у каждого адреса свой
+            self.assertTrue(limiter.allow('2.2.2.2'))
+
+        with patch('ratelimit.time.monotonic', return_value = 100.5):
+            self.assertTrue(limiter.allow('1.1.1.1'))
+            self.assertFalse(limiter.allow('1.1.1.1'))
+
+        # Запас не превышает burst
+        with patch('ratelimit.time.monotonic', return_value = 1000.0):
+            for i in range(3):
+                self.assertTrue(limiter.allow('1.1.1.1'))
+            self.assertFalse(limiter.allow('1.1.1.1'))
+
+    def test_prune(self):
+        limiter = RateLimiter(1, 2)
+        with patch('ratelimit.time.monotonic', return_value = 100.0):
+            limiter.allow('1.1.1.1')
+        with patch('ratelimit.time.monotonic', return_value = 101.5):
+            limiter.allow('2.2.2.2')
+        limiter.prune(102.5)
+        self.assertListEqual(list(limiter.buckets), ['2.2.2.2'])
+
+    def test_unlimited(self):
+        limiter = RateLimiter(0, 0)
+        for i in range(100):
+            self.assertTrue(limiter.allow('1.1.1.1'))
+        self.assertDictEqual(limiter.buckets, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import unittest, logging, json, os, rsa
+from base64 import b64decode, b64encode
+from hashlib import sha256
+import crypto, request_handler
+from processors import cc, sc
+from request_handler import RequestHandler, Connector
+
+from tornado.httpclient import HTTPRequest
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.web import Application
+from tornado.websocket import websocket_connect
+
+# Логгер модуля создается только при запуске сервера
+request_handler.log = logging.getLogger('request_handler')
+
+
+class TestConnector(AsyncHTTPTestCase):
+    handler = RequestHandler()
+    ip = '1.1.1.1'
+
+    nick = 'test_user'
+    pswd = sha256(b'pswd').hexdigest()
+    pub_key, priv_key = rsa.newkeys(1024, accurate = False)
+    key_string = '{}:{}'.format(pub_key.n, pub_key.e)
+
+    def get_app(self):
+        return Application([(r'/', Connector,
+                             dict(handler = self.handler))])
+
+    def connect(self):
+        url = self.get_url('/').replace('http', 'ws', 1)
+        return websocket_connect(HTTPRequest(url, headers = {
+            'X-Forwarded-For': self.ip}))
+
+    def frame(self, *data):
+        """Возвращает запрос с данными data, зашифрованный ключом сервера
+        и подписанный ключом клиента"""
+        server_key = self.handler.pr._parse_public_key(self.handler.get_key())
+        request = json.dumps(data)[1:-1].encode()
+        enc_request, enc_key = crypto.encrypt(request,
+                                              server_key).split(b':')
+        sign = b64encode(rsa.sign(b64decode(enc_request), self.priv_key,
+                                  'SHA-256'))
+        return b':'.join((enc_request, sign, enc_key)).decode()
+
+    def unpack(self, msg):
+        enc_response, enc_key = msg.split(b':')
+        response = crypto.decrypt(enc_response, enc_key, self.priv_key)
+        return json.loads('[' + response.decode() + ']')
+
+    def setUp(self):
+        super().setUp()
+        db = self.handler.pr.db
+        c = db.cursor()
+        c.execute('''INSERT INTO users VALUES (%s, %s)''',
+                  (self.nick, self.pswd))
+        db.commit()
+        c.close()
+
+    def tearDown(self):
+        self.handler.connections.clear()
+        db = self.handler.pr.db
+        c = db.cursor()
+        c.execute('''DELETE FROM sessions''')
+        c.execute('''DELETE FROM users''')
+        db.commit()
+        c.close()
+        super().tearDown()
+
+    def test_start_lanes(self):
+        handler = RequestHandler()
+        handler.normal_workers = 0
+        os.environ['FAST_WORKERS'] = str(handler.pr.pool_size)
+        try:
+            with self.assertRaises(ValueError):
+                handler.start()
+        finally:
+            del os.environ['FAST_WORKERS']
+
+    @gen_test
+    def test_pipelined_requests(self):
+        ws = yield self.connect()
+
+        # Запрос отправляется, не дожидаясь ответа на вход, и
+        # выполняется уже в открытой сессии
+        ws.write_message(self.frame(cc.login, '0', self.nick, self.pswd,
+                                    self.key_string))
+        ws.write_message(self.frame(cc.friends_group, '1'))
+        code, request_id, *data = self.unpack((yield ws.read_message()))
+        self.assertEqual((code, request_id), (sc.login_succ, '0'))
+        code, request_id, *data = self.unpack((yield ws.read_message()))
+        self.assertEqual((code, request_id),
+                         (sc.friends_group_response, '1'))
+        ws.close()
+
+    @gen_test
+    def test_malformed_request(self):
+        ws = yield self.connect()
+        ws.write_message('malformed')
+        self.assertIsNone((yield ws.read_message()))
+        self.assertIsNone(self.handler.connections[self.ip].ws_connection)
+
+    @gen_test
+    def test_ping_during_large_send(self):
+        ws = yield self.connect()
+        conn = self.handler.connections[self.ip]
+
+        # Ответ больше буферов сокета и остается в буфере потока,
+        # а ping пишет в поток после него, и Future записи ответа
+        # не завершается
+        reply = b'0' * (32 * 1024 * 1024)
+        conn.send(reply)
+        conn.ping(b'')
+        msg = yield ws.read_message()
+        self.assertEqual(len(msg), len(reply))
+
+        # Клиент принял все данные, и следующие ответы отправляются
+        for i in range(4):
+            reply = str(i).encode() * Connector.max_queue_bytes
+            conn.send(reply)
+            msg = yield ws.read_message()
+            self.assertEqual(msg, reply)
+        self.assertIsNotNone(conn.ws_connection)
+        ws.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+from session_store import *
+
+
+class TestMemoryStore(unittest.TestCase):
+    def setUp(self):
+        self.store = MemoryStore()
+
+    def test_add(self):
+        self.assertTrue(self.store.add(None, 'user1', ['1', '2'], 'ip1', 100,
+                                       b'sym', b'mac'))
+        self.assertFalse(self.store.add(None, 'user2', ['3', '4'], 'ip1', 100))
+        self.assertListEqual(self.store.all(None), [('user1', 'ip1')])
+
+    def test_remove(self):
+        self.store.add(None, 'user1', ['1', '2'], 'ip1', 100)
+        self.store.remove(None, 'ip1')
+        self.store.remove(None, 'ip1')
+        self.assertListEqual(self.store.all(None), [])
+        self.assertTrue(self.store.add(None, 'user1', ['1', '2'], 'ip1', 100))
+
+    def test_touch_and_reap(self):
+        for i in range(3):
+            self.store.add(None, 'user', ['1', '2'], 'ip{}'.format(i), 100)
+        self.assertEqual(self.store.touch(None, [('ip0', 300),
+                                                 ('closed_ip', 300)], 10), 1)
+
+        self.assertListEqual(sorted(self.store.reap(None, 200, 1)),
+                             ['ip1', 'ip2'])
+        self.assertListEqual(self.store.all(None), [('user', 'ip0')])
+        self.assertListEqual(self.store.reap(None, 200, 1), [])
+
+    def test_get_store(self):
+        self.assertIsInstance(get_store('memory'), MemoryStore)
+        self.assertIsInstance(get_store('postgres'), PostgresStore)
+        with self.assertRaises(ValueError):
+            get_store('redis')
+
+
+if __name__ == '__main__':
+    unittest.main()